@@ -0,0 +1,193 @@
+# --==BLOCK BLASTR ASYNCIO SERVER==--
+# An alternative to the select loop in server.Server, for running hundreds of connections in one process.
+# The game itself is unchanged, only how the sockets are served is different:
+#   - every connection has a reader task that decodes and processes messages as soon as they arrive, taking one read
+#     (READ_SIZE) a tick like the select loop, so a client sending faster than that waits in its socket.
+#   - every connection has a writer task sending from a bounded queue of tick updates.
+#   - the game tick runs as its own task at a fixed rate, queueing each client's update without waiting on any socket.
+#
+# SLOW CLIENTS
+# When a client's queue is full it is not keeping up, and what happens depends on slow_policy:
+#   "drop"          The oldest queued update is thrown away for the newest. Updates are deltas against the client's last
+#                   acked snapshot, so a dropped update is covered by the next one.
+#   "disconnect"    The client is removed.
+#
+# ASYNC SERVER CLASS
+# Attributes:   Type:       Description:
+#   queue_size      Integer     The most tick updates waiting to be sent to one client.
+#
+#   slow_policy     String      "drop" or "disconnect".
+#
+#   dropped         Integer     The number of updates thrown away for slow clients.
+#
+#   overruns        Integer     The number of times the tick fell too far behind and skipped ticks.
+#
+#   ticked          Event       Set at the end of every tick (and replaced with a new one), the reader tasks wait on it
+#                               between reads.
+#
+# Methods:      Parameters:     Description:
+#   serve           N/A             Starts listening and runs the tick until the server is stopped.
+#
+#   handle_client   reader, writer  The reader task of one connection.
+#
+#   write_updates   player (Player) The writer task of one connection.
+#
+#   tick_loop       N/A             Runs game_tick at tick_rate, keeping absolute deadlines so the rate does not drift.
+#
+#   game_tick       N/A             Updates the world, takes a snapshot and queues an update for every client. Slow clients
+#                                   are only disconnected once every update is built, as they are still in the snapshot.
+#
+#   queue_update    player (Player) Queues a client's update, applying slow_policy if their queue is full. Returns False for
+#                                   a client to be disconnected.
+#
+#   metrics         N/A             Server.metrics with this server's overruns and dropped updates.
+
+import asyncio
+import signal
+
+from protocol import READ_SIZE, SERVER_MESSAGES, ProtocolError
+from server import VIEW_RADIUS, Server
+
+
+class AsyncServer(Server):
+    def __init__(self, hostname, port=6000, tick_rate=60, view_radius=VIEW_RADIUS, queue_size=8, slow_policy="drop", rate_limits=None):
+        Server.__init__(self, hostname, port, tick_rate, view_radius, rate_limits=rate_limits)
+        self.queue_size = queue_size
+        self.slow_policy = slow_policy
+        self.dropped = 0
+        self.overruns = 0
+        self.ticked = asyncio.Event()
+
+    async def serve(self):
+        self.server_state = "INITIALISING"
+        self.server = await asyncio.start_server(self.handle_client, self.hostname, self.port)
+        self.server_state = "CONNECTED"
+        try:
+            await self.tick_loop()
+        finally:
+            self.stop_server()
+
+    async def handle_client(self, reader, writer):
+        player_id = self.add_player(writer)
+        if player_id is None:
+            # The server is full.
+            writer.close()
+            return
+        player = self.players[player_id]
+        # The hello is written straight away, the queue only ever holds tick updates so any of them can be dropped.
+        writer.write(bytes(player.outbox))
+        player.outbox.clear()
+        player.queue = asyncio.Queue(self.queue_size)
+        player.writer_task = asyncio.create_task(self.write_updates(player))
+        try:
+            while self.players.get(player_id) is player:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.receive_data(player_id, data)
+                # The next read waits for the next tick, however much more the client has sent.
+                await self.ticked.wait()
+        except (ProtocolError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # The server is shutting down.
+            pass
+        finally:
+            # Whatever ended the connection, the player never stays behind without a reader.
+            if self.players.get(player_id) is player:
+                self.remove_player(player_id)
+
+    async def write_updates(self, player):
+        try:
+            while True:
+                data = await player.queue.get()
+                player.connection.write(data)
+                player.bytes_out += len(data)
+                await player.connection.drain()
+        except ConnectionError:
+            pass
+
+    async def tick_loop(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.tick_rate
+        next_tick = loop.time()
+        while self.server_state == "CONNECTED":
+            self.game_tick()
+            next_tick += interval
+            delay = next_tick - loop.time()
+            if delay < -interval * 5:
+                # Too far behind to catch up, skip the missed ticks.
+                self.overruns += 1
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(max(delay, 0))
+
+    def game_tick(self):
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+        self.update_world()
+        self.take_snapshot()
+        if profiler:
+            profiler.mark("snapshot")
+        slow = list()
+        for player in list(self.players.values()):
+            # Events skip the queue, so they are never dropped with a stale update.
+            if player.events:
+                player.connection.write(bytes(player.events))
+                player.bytes_out += len(player.events)
+                player.events.clear()
+            if not self.queue_update(player):
+                slow.append(player.identity)
+        for player_id in slow:
+            self.remove_player(player_id)
+        self.ticked.set()
+        self.ticked = asyncio.Event()
+        if profiler:
+            profiler.mark("output")
+            profiler.finish()
+            self.publish_metrics()
+
+    def queue_update(self, player):
+        if player.queue.full():
+            if self.slow_policy == "disconnect":
+                return False
+            player.queue.get_nowait()
+            self.dropped += 1
+        player.queue.put_nowait(self.build_update(player))
+        player.updates_out += 1
+        return True
+
+    def metrics(self):
+        metrics = Server.metrics(self)
+        metrics["overruns"] = self.overruns
+        metrics["dropped"] = self.dropped
+        return metrics
+
+    def remove_player(self, client_id):
+        player = self.players.pop(client_id)
+        del self.connections[player.connection]
+        self.player_ids.release(client_id)
+        player.writer_task.cancel()
+        if self.recorder:
+            self.recorder.record(self.tick, b"x", client_id)
+        try:
+            player.connection.write(SERVER_MESSAGES.encode("x"))
+            player.connection.close()
+        except ConnectionError:
+            pass
+
+    def stop_server(self):
+        for player_id in list(self.players):
+            self.remove_player(player_id)
+        self.server.close()
+        self.server_state = "OFFLINE"
+        self.stop_recording()
+
+    def run_headless(self):
+        print("Server running at " + self.hostname + ":" + str(self.port) + ", " + str(self.tick_rate) + " ticks per second (asyncio)")
+        signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,335 @@
+# --==BLOCK BLASTR BENCHMARKS==--
+# Times the hot paths of the server and the client at 10, 100 and 1000 entities, without a display or any sockets.
+# Each benchmark is run in batches until a batch takes at least MIN_TIME, and the fastest of REPEATS batches is kept
+# (the least disturbed by anything else running), as seconds per call.
+#
+# BENCHMARKS
+#   decode_client       Decoding a read holding a position message from every player (Server.receive_data).
+#   decode_frame        Decoding a full resync frame (the receiver thread in Client).
+#   receive_copy        Reading a position message per entity off a socket with recv and feeding it to a FrameDecoder
+#                       (Server.read_client).
+#   receive_into        The same read with recv_into straight into the decoder's buffer, kept to compare against. It has not
+#                       measured faster, so the game reads with recv (see protocol.py).
+#   encode_positions    Encoding a position message per entity (Client.sendplayerdata).
+#   build_full          Building a full resync frame with the whole map in view (Server.build_update).
+#   build_delta         Building the frame for one tick of changes (Server.build_update).
+#                       Both build the delta every call, as for the first client of a tick, the rest acking the same
+#                       snapshot share it.
+#   laser_update        Moving, culling and compacting every laser (LaserStore.update).
+#   laser_frames        Encoding every laser (LaserStore.encode).
+#   allocate_ids        Allocating and releasing an id per entity (Registry).
+#   check_collisions    Checking every laser against the walls and the players (Server.check_collisions).
+#   blocked             Checking a player box against the walls per entity (the client's movement check).
+#   blocked_many        Checking every laser against the walls at once (CollisionMap.blocked_many).
+# Players are capped at MAX_PLAYERS, so at the larger scales the rest of the entities are lasers.
+#
+# ALLOCATIONS
+# The receive benchmarks are also run once under tracemalloc, giving the most memory each call has in use at once beyond
+# what it started with, per message read. The decoded messages themselves are the same either way, the difference is
+# what reading them costs.
+#
+# RESULTS
+# Written as JSON: {"meta": {...}, "results": {"name/scale": seconds per call, ...}, "allocations": {"name/scale": bytes per message, ...}}
+# With --compare, each result is shown against the same one in an earlier results file, and the run fails if anything
+# is slower by more than --threshold.
+#
+# RUNNING
+#   python -m bench                                     Runs everything and prints the results.
+#   python -m bench --output new.json --compare old.json --threshold 0.2
+#   python -m bench --filter laser                      Runs only the benchmarks with "laser" in their name.
+
+import argparse
+import json
+import platform
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from world import PLAYER_SIZE, WORLD_SIZE, CollisionMap, box
+from protocol import CLIENT_MESSAGES, READ_SIZE, SERVER_MESSAGES, FrameDecoder
+from server import MAX_PLAYERS, LaserStore, Registry, Server
+
+SCALES = (10, 100, 1000)
+REPEATS = 5
+MIN_TIME = 0.05
+
+
+class Connection:
+    # Stands in for a client socket, the server only needs something to key its connections on.
+    pass
+
+
+def open_positions(count, rng):
+    collision_map = CollisionMap()
+    positions = list()
+    while len(positions) < count:
+        position = (rng.randint(5, WORLD_SIZE - 6), rng.randint(5, WORLD_SIZE - 6))
+        if not collision_map.blocked(box(position, PLAYER_SIZE)):
+            positions.append(position)
+    return positions
+
+
+def make_server(count, view_radius=0):
+    # A server with up to MAX_PLAYERS ready players, and lasers making up the rest of count.
+    rng = random.Random(count)
+    server = Server("bench", view_radius=view_radius)
+    players = min(count, MAX_PLAYERS)
+    connections = [Connection() for index in range(0, players)]
+    positions = open_positions(players + count, rng)
+    for index, connection in enumerate(connections):
+        server.add_player(connection)
+        server.process_data("c", (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)), connection)
+        server.process_data("n", ("p" + str(index),), connection)
+        server.process_data("p", positions[index], connection)
+        server.process_data("h", (10,), connection)
+    # Lasers are added straight to the store, as the server fires them from their owner's position.
+    for index in range(0, max(count - players, 1)):
+        laser_id = server.laser_ids.allocate()
+        owner = index % players
+        server.lasers.add(laser_id, server.laser_ids.generation(laser_id), owner, server.player_ids.generation(owner), server.players[owner].properties["c"],
+                          rng.choice("wasd"), positions[players + index], server.tick)
+    server.take_snapshot()
+    return server, connections
+
+
+def make_lasers(count):
+    rng = random.Random(count)
+    lasers = LaserStore(count)
+    for laser_id in range(0, count):
+        lasers.add(laser_id, 0, 0, 0, (255, 0, 0), rng.choice("wasd"), (rng.randint(100, 900), rng.randint(100, 900)), 0)
+    return lasers
+
+
+def bench_decode_client(count):
+    data = position_messages(count)
+    decoder = FrameDecoder(CLIENT_MESSAGES)
+    return lambda: decoder.feed(data)
+
+
+def bench_decode_frame(count):
+    server, connections = make_server(count)
+    data = server.build_update(server.players[0])
+    decoder = FrameDecoder(SERVER_MESSAGES)
+    return lambda: decoder.feed(data)
+
+
+def position_messages(count):
+    return b"".join([CLIENT_MESSAGES.encode("p", index % WORLD_SIZE, index % WORLD_SIZE) for index in range(0, count)])
+
+
+def bench_receive_copy(count):
+    data = position_messages(count)
+    sender, receiver = socket.socketpair()
+    decoder = FrameDecoder(CLIENT_MESSAGES)
+
+    def run():
+        sender.sendall(data)
+        left = len(data)
+        messages = list()
+        while left:
+            received = receiver.recv(READ_SIZE)
+            left -= len(received)
+            messages += decoder.feed(received)
+        return messages
+    return run
+
+
+def bench_receive_into(count):
+    data = position_messages(count)
+    sender, receiver = socket.socketpair()
+    decoder = FrameDecoder(CLIENT_MESSAGES)
+
+    def run():
+        sender.sendall(data)
+        left = len(data)
+        messages = list()
+        while left:
+            decoder.reserve(READ_SIZE)
+            count = receiver.recv_into(decoder.view[decoder.end:decoder.end + READ_SIZE])
+            decoder.end += count
+            left -= count
+            messages += decoder.decode()
+        return messages
+    return run
+
+
+def bench_encode_positions(count):
+    positions = [(index % WORLD_SIZE, index % WORLD_SIZE) for index in range(0, count)]
+    encode = CLIENT_MESSAGES.encode
+    return lambda: [encode("p", x, y) for x, y in positions]
+
+
+def bench_build_full(count):
+    server, connections = make_server(count)
+    viewer = server.players[0]
+
+    def run():
+        viewer.acked = 0
+        server.deltas.clear()
+        server.build_update(viewer)
+    return run
+
+
+def bench_build_delta(count):
+    server, connections = make_server(count)
+    viewer = server.players[0]
+    server.build_update(viewer)
+    viewer.acked = server.tick
+    # One tick on: every laser has moved and every player has sent a new position.
+    for connection in connections:
+        position = server.players[server.sock_to_id(connection)].properties["p"]
+        server.process_data("p", (position[0] + 1, position[1]), connection)
+    server.update_world()
+    server.take_snapshot()
+
+    def run():
+        server.deltas.clear()
+        server.build_update(viewer)
+    return run
+
+
+def bench_laser_update(count):
+    lasers = make_lasers(count)
+    # The same tick every time, so each call does the full amount of work and no laser ever leaves the map.
+    return lambda: lasers.update(1)
+
+
+def bench_laser_frames(count):
+    lasers = make_lasers(count)
+    return lambda: lasers.encode(numpy.flatnonzero(lasers.alive[:lasers.count])).tobytes()
+
+
+def bench_allocate_ids(count):
+    registry = Registry(count)
+
+    def run():
+        ids = [registry.allocate() for index in range(0, count)]
+        registry.release_many(numpy.array(ids))
+    return run
+
+
+def bench_check_collisions(count):
+    server, connections = make_server(count)
+    return server.check_collisions
+
+
+def bench_blocked(count):
+    collision_map = CollisionMap()
+    rects = [box(position, PLAYER_SIZE) for position in open_positions(count, random.Random(count))]
+    return lambda: [collision_map.blocked(rect) for rect in rects]
+
+
+def bench_blocked_many(count):
+    collision_map = CollisionMap()
+    positions = numpy.array(open_positions(count, random.Random(count)), numpy.int32)
+    return lambda: collision_map.blocked_many(positions, 3)
+
+
+BENCHMARKS = {"decode_client": bench_decode_client, "decode_frame": bench_decode_frame, "receive_copy": bench_receive_copy,
+              "receive_into": bench_receive_into, "encode_positions": bench_encode_positions,
+              "build_full": bench_build_full, "build_delta": bench_build_delta, "laser_update": bench_laser_update,
+              "laser_frames": bench_laser_frames, "allocate_ids": bench_allocate_ids, "check_collisions": bench_check_collisions,
+              "blocked": bench_blocked, "blocked_many": bench_blocked_many}
+
+# Benchmarks also measured for memory, each call reads this many messages at a scale of count.
+ALLOCATION_BENCHMARKS = ("receive_copy", "receive_into")
+
+
+def time_call(function):
+    # Finds how many calls make a batch of at least MIN_TIME, then keeps the fastest of REPEATS batches.
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for index in range(0, calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIME:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for repeat in range(1, REPEATS):
+        start = time.perf_counter()
+        for index in range(0, calls):
+            function()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+def run(names):
+    results = dict()
+    for name in names:
+        for count in SCALES:
+            key = name + "/" + str(count)
+            results[key] = time_call(BENCHMARKS[name](count))
+            print("%-26s %12.2f us" % (key, results[key] * 1e6))
+    return results
+
+
+def peak_allocated(function):
+    # The most memory a call has in use at once beyond what it started with, in bytes.
+    function()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - before
+
+
+def run_allocations(names):
+    allocations = dict()
+    for name in names:
+        if name not in ALLOCATION_BENCHMARKS:
+            continue
+        for count in SCALES:
+            key = name + "/" + str(count)
+            allocations[key] = peak_allocated(BENCHMARKS[name](count)) / count
+            print("%-26s %12.1f bytes per message" % (key, allocations[key]))
+    return allocations
+
+
+def compare(results, baseline, threshold):
+    # Prints each result against the baseline, returns the keys that are slower by more than threshold.
+    slower = list()
+    for key, seconds in results.items():
+        old = baseline.get(key)
+        if old is None:
+            print("%-26s %12.2f us   (not in baseline)" % (key, seconds * 1e6))
+            continue
+        change = seconds / old - 1
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            slower.append(key)
+        print("%-26s %12.2f us  %12.2f us  %+7.1f%%%s" % (key, old * 1e6, seconds * 1e6, change * 100, flag))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLASTR microbenchmarks")
+    parser.add_argument("--filter", default="", help="only run benchmarks with this in their name")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="how much slower (0.2 is 20%%) counts as a regression")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names)
+    print()
+    allocations = run_allocations(names)
+    if args.output:
+        meta = {"python": platform.python_version(), "numpy": numpy.__version__, "machine": platform.machine(), "time": time.time()}
+        with open(args.output, "w") as file:
+            json.dump({"meta": meta, "results": results, "allocations": allocations}, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        print()
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print(str(len(slower)) + " slower than the baseline: " + ", ".join(slower))
+            sys.exit(1)
@@ -1,5 +1,23 @@
 import pygame
+import select
 import socket
+import time
+from collections import deque
+import _thread as thread
+
+from world import GAME_MAP, PLAYER_SIZE, WORLD_SIZE, CollisionMap, box, laser_position
+from protocol import CLIENT_MESSAGES, SERVER_MESSAGES, DATAGRAM_HEADER, MAX_DATAGRAM, PROTOCOL_VERSION, PLAYER_FIELDS, READ_SIZE, SNAPSHOT_HISTORY, FrameDecoder, ProtocolError
+from textcache import TextCache
+
+# The client's own player is simulated STEP_RATE times a second however fast the frames are drawn, so moving and
+# shooting are the same speed on every machine. Frames are capped at FRAME_RATE, and after a stall at most MAX_STEPS
+# steps are caught up.
+STEP_RATE = 60
+FRAME_RATE = 120
+MAX_STEPS = 5
+
+# How many datagrams in a row carry a new position over the UDP channel.
+POSITION_REPEATS = 8
 
 
 # Use a players array based on id, based the players creation function from the server to add attributes.
@@ -12,35 +30,182 @@ class Player:
         self.position = False
         self.kills = 0
         self.status = False
-
-    def update(self, data):
-        if data[0] == "n":
-            self.name = data[1:]
-        elif data[0] == "c":
-            self.colour = (int(data[1:4]), int(data[4:7]), int(data[7:10]))
-        elif data[0] == "h":
-            self.health = int(data[1:])
-        elif data[0] == "p":
-            self.position = (int(data[1:5]), int(data[5:9]))
-        elif data[0] == "k":
-            self.kills = int(data[1:])
+        # Where the player was before they last moved, and the tick of the snapshot they moved in.
+        self.previous_position = False
+        self.moved_tick = 0
+
+    def update(self, state, tick):
+        # state holds the player's fields in PLAYER_FIELDS order, as kept in a snapshot.
+        previous_position = self.position
+        self.colour, self.name, self.position, self.health, self.kills = state
+        if self.position != previous_position:
+            self.previous_position = previous_position
+            self.moved_tick = tick
         self.status = all([self.colour, self.name, self.health, self.position])
 
+    def position_between(self, tick, fraction):
+        # Where to draw the player a fraction of the way from the snapshot before tick to the one at tick.
+        if self.moved_tick != tick or not self.previous_position:
+            return self.position
+        return [old + (new - old) * fraction for old, new in zip(self.previous_position, self.position)]
+
 
 class Laser:
-    def __init__(self, data):
-        self.laser_id = data[0:3]
-        self.player_id = data[3:5]
-        self.colour = (int(data[5:8]), int(data[8:11]), int(data[11:14]))
-        self.position = [int(data[14:18]), int(data[18:22])]
+    def __init__(self, laser_id, state):
+        # state is what the laser spawn carried, which never changes, so the position is worked out from the tick.
+        self.laser_id = laser_id
+        self.generation = state[0]
+        self.player_id = state[1]
+        self.colour = state[2:5]
+        self.origin = state[5:7]
+        self.direction = state[7]
+        self.spawn_tick = state[8]
+
+    def position_at(self, tick):
+        return laser_position(self.origin, self.direction, self.spawn_tick, tick)
+
+
+class Receiver:
+    # What the receiver thread of one connection works with. Each connection gets a new one, so a thread left over from an
+    # old connection only ever decodes into, rebuilds snapshots in and posts to its own, never the new connection's.
+    def __init__(self, client, connection):
+        self.client = client
+        self.connection = connection
+        self.decoder = FrameDecoder(SERVER_MESSAGES)
+        # The recent snapshots by number (for use as baselines) and the frame being received.
+        self.snapshots = dict()
+        self.frame = None
+        # The newest snapshot finished, frames older than it (one overtaken by a datagram) are dropped.
+        self.latest_snapshot = 0
+        # What the thread passes to the game loop: finished snapshots and events, in the order they arrived.
+        # deque appends and pops are atomic, so neither side has to lock or wait on the other.
+        self.mailbox = deque()
+
+    def run(self):
+        # Runs on the receiver thread for as long as the connection is open, decoding everything as soon as it arrives.
+        connection = self.connection
+        mailbox = self.mailbox
+        sockets = [connection]
+        try:
+            while True:
+                readable = select.select(sockets, [], [])[0]
+                if len(sockets) > 1 and sockets[1] in readable:
+                    self.receive_datagram(sockets[1])
+                if connection not in readable:
+                    continue
+                received = connection.recv(READ_SIZE)
+                if not received:
+                    break
+                for kind, fields in self.decoder.feed(received):
+                    if kind == "u":
+                        self.start_frame(fields[0], fields[1], fields[2])
+                    elif kind == "y":
+                        # Only the current connection's receiver can open the client's channel.
+                        if self.client.receiver is self:
+                            sockets[1:] = self.client.open_channel(fields[0], fields[1])
+                    elif kind in ("i", "x", "t", "d"):
+                        mailbox.append((kind, fields))
+                    elif self.frame is not None:
+                        self.frame_data(kind, fields)
+        except (ProtocolError, OSError):
+            pass
+        for datagram in sockets[1:]:
+            datagram.close()
+        mailbox.append(("x", ()))
+
+    def receive_datagram(self, datagram):
+        try:
+            messages = SERVER_MESSAGES.decode_all(datagram.recv(MAX_DATAGRAM))
+        except (ProtocolError, OSError):
+            # Damaged, or an error left by an earlier datagram, either way dropped like a lost one.
+            return
+        if not messages or messages[0][0] != "u" or messages[0][1][0] <= self.latest_snapshot:
+            return
+        # A datagram is a whole frame, so it is built aside from any frame part way through arriving over TCP.
+        pending = self.frame
+        self.start_frame(*messages[0][1])
+        for kind, fields in messages[1:]:
+            if self.frame is None:
+                break
+            self.frame_data(kind, fields)
+        self.frame = pending
+
+    def start_frame(self, snapshot_id, baseline_id, count):
+        if baseline_id and baseline_id not in self.snapshots:
+            # The baseline has been dropped already, so the frame cannot be rebuilt. Ask for a full resync instead.
+            self.frame = None
+            self.mailbox.append(("a", (0,)))
+            return
+        self.frame = [snapshot_id, dict(self.snapshots.get(baseline_id, dict())), count]
+        if count == 0:
+            self.finish_frame()
+
+    def frame_data(self, kind, fields):
+        world = self.frame[1]
+        if kind == "v":
+            world[("l", fields[0])] = fields[1:]
+        elif kind == "o":
+            world.pop(("l", fields[0]), None)
+        elif kind == "z":
+            world.pop(("p", fields[0]), None)
+        elif kind == "q":
+            # The player has left this client's area of interest, they are kept but not drawn until they come back.
+            state = list(world.get(("p", fields[0]), (None,) * len(PLAYER_FIELDS)))
+            state[PLAYER_FIELDS.index("p")] = None
+            world[("p", fields[0])] = tuple(state)
+        elif kind in PLAYER_FIELDS:
+            state = list(world.get(("p", fields[0]), (None,) * len(PLAYER_FIELDS)))
+            state[PLAYER_FIELDS.index(kind)] = fields[1:] if kind in ("c", "p") else fields[1]
+            world[("p", fields[0])] = tuple(state)
+        self.frame[2] -= 1
+        if self.frame[2] == 0:
+            self.finish_frame()
+
+    def finish_frame(self):
+        snapshot_id, world, count = self.frame
+        self.frame = None
+        if snapshot_id <= self.latest_snapshot:
+            # Overtaken by a newer frame that came over UDP.
+            return
+        self.latest_snapshot = snapshot_id
+        self.snapshots[snapshot_id] = world
+        for old_id in [old_id for old_id in self.snapshots if old_id <= snapshot_id - SNAPSHOT_HISTORY]:
+            del self.snapshots[old_id]
+        self.mailbox.append(("u", (snapshot_id, world)))
 
 
 class Client(Player):
     def __init__(self):
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # self.connection.setblocking(True)
+        # Replaced with a new one, along with its thread, for every connection.
+        self.receiver = Receiver(self, self.connection)
+        # The walls are baked once, moving is then checked with a few lookups instead of against every wall.
+        self.collision_map = CollisionMap(GAME_MAP)
+        self.identity = None
+        # The server ticks of the snapshot shown and the one before it, and when each was shown, for interpolating between them.
+        self.tick = 0
+        self.previous_tick = 0
+        self.snapshot_time = 0
+        self.previous_snapshot_time = 0
         self.players = dict()
         self.lasers = dict()
+        # The snapshot shown.
+        self.world = dict()
+        # The UDP channel, when the server offers one (see UDP CHANNEL in protocol.py). Positions and acks go out in a
+        # datagram at each flush instead of over TCP, and the receiver thread takes frames from it as well.
+        self.datagram = None
+        self.udp_token = 0
+        self.udp_sequence = 0
+        self.datagram_outbox = bytearray()
+        # Everything sent during a frame waits here until flush, so it goes out in one write. Positions are only queued
+        # at flush, and only if different from the last one the server was sent (sent_position).
+        self.outbox = bytearray()
+        self.position_pending = False
+        self.sent_position = None
+        self.position_repeats = 0
+        # Set to the killer's name when the server says this client has been killed.
+        self.killed_by = None
         self.name = str()
         self.colour = tuple()
         self.health = int()
@@ -48,64 +213,162 @@ class Client(Player):
         self.kills = int()
 
     def connect(self, ip):
+        # Each connection gets its own socket and Receiver (decoder, snapshots and mailbox) for its thread.
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.receiver = Receiver(self, self.connection)
+        self.outbox = bytearray()
+        self.position_pending = False
+        self.sent_position = None
+        self.position_repeats = 0
+        self.server_ip = ip
+        self.datagram = None
+        self.udp_token = 0
+        self.udp_sequence = 0
+        self.datagram_outbox = bytearray()
         try:
             self.connection.connect((ip, 6000))
-            return True
+            # Writes are already batched into one a frame, so there is nothing for Nagle's algorithm to do but hold them back.
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.senddata(CLIENT_MESSAGES.encode("i", PROTOCOL_VERSION))
+            self.flush()
         except ConnectionError:
             return False
+        thread.start_new_thread(self.receiver.run, ())
+        return True
 
-    def senddata(self, data):
-        self.connection.sendall(data.encode())
-
-    def receivedata(self):
-        return self.connection.recv(1024).decode()
+    def senddata(self, data, unreliable=False):
+        # Unreliable data is superseded by the next of its kind, so it goes over the UDP channel when there is one.
+        if unreliable and self.udp_token and self.datagram is not None:
+            self.datagram_outbox += data
+        else:
+            self.outbox += data
+
+    def flush(self):
+        # Sends everything queued since the last flush, called once at the end of each frame.
+        datagram = self.datagram
+        if self.position_pending or self.position_repeats:
+            position = (int(self.position[0]), int(self.position[1]))
+            if position != self.sent_position:
+                self.sent_position = position
+                # A lost datagram is only made up for by a later one, so over UDP a new position goes in the next few.
+                self.position_repeats = POSITION_REPEATS if self.udp_token and datagram is not None else 1
+            if self.position_repeats:
+                self.senddata(CLIENT_MESSAGES.encode("p", *position), True)
+                self.position_repeats -= 1
+            self.position_pending = False
+        if self.datagram_outbox:
+            self.udp_sequence += 1
+            try:
+                datagram.send(DATAGRAM_HEADER.pack(self.udp_token, self.udp_sequence) + self.datagram_outbox)
+            except (OSError, AttributeError):
+                # Lost like any other datagram, or the channel has just been closed.
+                pass
+            self.datagram_outbox.clear()
+        if self.outbox:
+            try:
+                self.connection.sendall(self.outbox)
+            except OSError:
+                # The connection has gone, which the receiver thread passes on through the mailbox.
+                pass
+            self.outbox.clear()
+
+    def open_channel(self, token, port):
+        # Opens the UDP channel the server has offered, or closes it for a token of 0. Gives the sockets to wait on.
+        self.udp_token = 0
+        if self.datagram is not None:
+            self.datagram.close()
+            self.datagram = None
+        if not token:
+            # Whatever went over UDP may not have arrived, so the position is sent again over TCP.
+            self.sent_position = None
+            return []
+        datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagram.connect((self.server_ip, port))
+        self.datagram = datagram
+        self.udp_token = token
+        return [datagram]
 
     def sendplayerdata(self, item):
         if item == "p":
-            self.senddata("+p" + str(self.position[0]).split(".")[0].zfill(4) + str(self.position[1]).split(".")[0].zfill(4))
+            # However many steps moved the player this frame, only where they ended up is sent.
+            self.position_pending = True
         elif item == "c":
-            self.senddata("+c" + "".join([str(colour).zfill(3) for colour in self.colour]))
+            self.senddata(CLIENT_MESSAGES.encode("c", *self.colour))
         elif item == "h":
-            self.senddata("+h" + str(self.health).zfill(3))
+            self.senddata(CLIENT_MESSAGES.encode("h", self.health))
         elif item == "n":
-            self.senddata("+n" + self.name + " " * (8 - len(self.name)))
-        elif item[0] == "o":
-            self.senddata("+o" + item[1:])
-        elif item[0] == "k":
-            self.senddata("+k" + item[1:])
+            self.senddata(CLIENT_MESSAGES.encode("n", self.name))
 
         # for lasers:
         elif item in list("wasd"):
-            self.senddata("+l" + item + str(self.position[0]).zfill(4) + str(self.position[1]).zfill(4))
+            self.senddata(CLIENT_MESSAGES.encode("l", item, int(self.position[0]), int(self.position[1])))
 
     def update_game(self):
-        self.lasers.clear()
-        try:
-            received = self.receivedata()
-            for command in received.split("+"):
-                if command == '':
-                    pass
-                elif command == "u":
-                    pass
-                elif command[0] == "v":
-                    try:
-                        self.lasers[command[1:4]] = Laser(command[1:])
-                    except ValueError:
-                        pass
+        # Takes everything out of the mailbox without waiting on the network. Events are handled in order, but of the
+        # snapshots finished since the last frame only the newest is shown and acked.
+        newest = None
+        mailbox = self.receiver.mailbox
+        while mailbox:
+            kind, fields = mailbox.popleft()
+            if kind == "u":
+                newest = fields
+            elif kind == "a":
+                self.senddata(CLIENT_MESSAGES.encode("a", 0), True)
+            elif kind == "i":
+                if fields[0] != PROTOCOL_VERSION:
+                    self.disconnect()
+                    return
+                self.identity = fields[1]
+            elif kind == "x":
+                self.disconnect()
+                return
+            elif kind == "t":
+                if fields[0] == self.identity:
+                    self.health = fields[2]
+            elif kind == "d":
+                if fields[0] == self.identity:
+                    # The server forgets a dead player's position, so the one after respawning is always sent.
+                    self.sent_position = None
+                    self.position_repeats = 0
+                    if fields[1] in self.players:
+                        self.killed_by = self.players[fields[1]].name
+                    else:
+                        self.killed_by = str()
+                elif fields[1] == self.identity:
+                    self.kills += 1
+        if newest is not None:
+            self.show_snapshot(newest[0], newest[1])
+
+    def show_snapshot(self, snapshot_id, world):
+        # Only the players and lasers that differ from the snapshot shown last need their objects touching.
+        for key, state in world.items():
+            if self.world.get(key) != state:
+                if key[0] == "p":
+                    if key[1] not in self.players:
+                        self.players[key[1]] = Player(key[1])
+                    self.players[key[1]].update(state, snapshot_id)
                 else:
-                    identity = command[0:2]
-                    data = command[2:]
-                    if identity not in self.players:
-                        self.players[identity] = Player(identity)
-                    if data[0] == "z":
-                        del self.players[identity]
-                    elif data[0] == "x":
-                        self.disconnect()
-                    elif data[0] in list("nchpk"):
-                        self.players[identity].update(data)
-
-        except IndexError:
-            pass
+                    self.lasers[key[1]] = Laser(key[1], state)
+        for key in self.world:
+            if key not in world:
+                if key[0] == "p":
+                    self.players.pop(key[1], None)
+                else:
+                    self.lasers.pop(key[1], None)
+        self.world = world
+        self.previous_tick = self.tick
+        self.previous_snapshot_time = self.snapshot_time
+        self.tick = snapshot_id
+        self.snapshot_time = time.perf_counter()
+        self.senddata(CLIENT_MESSAGES.encode("a", snapshot_id), True)
+
+    def render_fraction(self):
+        # How far drawing has got from the snapshot before the one shown to the one shown. Everything remote is drawn
+        # up to one snapshot behind, moving smoothly between the two over as long as the last snapshot took to arrive.
+        interval = self.snapshot_time - self.previous_snapshot_time
+        if interval <= 0:
+            return 1
+        return min((time.perf_counter() - self.snapshot_time) / interval, 1)
 
     def validip(self, ip):
         if all([character in list("0123456789.") for character in ip]):
@@ -119,8 +382,14 @@ class Client(Player):
 
     def disconnect(self):
         self.players.clear()
+        self.lasers.clear()
+        self.world = dict()
+        self.killed_by = None
         try:
-            self.senddata("+x")
+            self.senddata(CLIENT_MESSAGES.encode("x"))
+            self.flush()
+            # Wakes the receiver thread, which is most likely waiting in select.
+            self.connection.shutdown(socket.SHUT_RDWR)
         except socket.error:
             pass
         self.connection.close()
@@ -139,6 +408,10 @@ class Mainloop(Client):
         self.window = pygame.display.set_mode(self.window_size, pygame.RESIZABLE)
         pygame.display.set_caption("BLASTR")
         Client.__init__(self)
+        # Fonts and rendered labels are reused between frames, text_cache.hits and text_cache.misses show how well.
+        self.text_cache = TextCache()
+        self.map_layer = None
+        self.map_layer_size = None
 
         self.stage = self.start_screen
         while True:
@@ -146,7 +419,7 @@ class Mainloop(Client):
 
     def display_text(self, text, size, colour, position, anchor, rel):
         # text = string, size = integer, colour = (RRR, GGG, BBB), position = (float, float), anchor = centre, left, right, top, bottom.
-        text_surface = pygame.font.Font("freesansbold.ttf", size).render(text, True, colour)
+        text_surface = self.text_cache.render(text, size, colour)
         text_rect = text_surface.get_rect()
         if rel:
             if anchor == "center":
@@ -167,6 +440,7 @@ class Mainloop(Client):
             elif anchor == "midbottom":
                 text_rect.midbottom = position
         self.window.blit(text_surface, text_rect)
+        return text_rect
 
     def display_rect(self, pos, size, colour, rel):
         if rel:
@@ -181,6 +455,17 @@ class Mainloop(Client):
         self.display_text(text, text_size, text_colour, rect.center, anchor, False)
         return rect
 
+    def build_map_layer(self):
+        # The whole map drawn once at the window's scale, so each frame only has to blit the part the camera can see.
+        # Two colours are all it needs, so it is kept at 8 bits a pixel to save memory on big windows.
+        self.map_layer_size = self.window_size
+        size = self.pos_to_coords([WORLD_SIZE, WORLD_SIZE], False)
+        self.map_layer = pygame.Surface((int(size[0]), int(size[1])), 0, 8)
+        self.map_layer.set_palette([(255, 255, 255), (50, 50, 50)])
+        self.map_layer.fill((255, 255, 255))
+        for position, wall_size in GAME_MAP:
+            pygame.draw.rect(self.map_layer, (50, 50, 50), pygame.Rect(self.pos_to_coords(position, False), self.pos_to_coords(wall_size, False)))
+
     def pos_to_coords(self, coords, rel_screen):
         coords = [coords[0], coords[1]]
         screen_size = [200, 200]
@@ -354,6 +639,8 @@ class Mainloop(Client):
                     self.disconnect()
                     pygame.display.quit()
                     quit()
+            # The acks queued by update_game, so the server can keep sending deltas while the player is set up.
+            self.flush()
             pygame.display.update()
 
     def game_loop(self):
@@ -370,116 +657,110 @@ class Mainloop(Client):
         self.sendplayerdata("h")
         self.sendplayerdata("n")
 
-        # The map in world coordinates
-        game_map = [[(40, 40), (80, 440)], [(160, 40), (600, 40)], [(760, 40), (120, 320)], [(160, 120), (520, 80)], [(320, 200), (80, 240)], [(160, 240), (80, 80)], [(440, 240), (160, 120)],
-                    [(640, 240), (80, 320)], [(40, 520), (80, 440)], [(160, 360), (80, 80)], [(160, 440), (40, 440)], [(920, 40), (40, 240)], [(240, 640), (80, 240)], [(320, 640), (80, 40)],
-                    [(400, 640), (160, 240)], [(760, 400), (40, 320)], [(160, 920), (640, 40)], [(760, 800), (40, 120)], [(600, 800), (160, 80)], [(920, 320), (40, 240)], [(920, 600), (40, 240)],
-                    [(840, 400), (40, 560)], [(880, 880), (80, 80)]]
+        # The rects drawn over the map last frame and where the camera was. While the camera stays put only those rects
+        # need the map putting back and pushing to the display, otherwise the whole window is redrawn.
+        drawn_rects = list()
+        last_camera = None
 
-        # The arrays to hold rects of objects in game (so that rect.colliderect(rect) can be used)
-        map_rects = list()
-        player_rects = list()
-        laser_rects = dict()
-
-        # Laser countdown variable:
+        # Laser countdown variable, in steps:
         laser_cooldown = 0
 
-        # Death screen requires the killing player's name:
-        killed_by = str()
+        clock = pygame.time.Clock()
+        step_time = 0
 
         # Buttons for :
         quit_button = None
         respawn_button = None
 
         while True:
+            # Waits out the rest of the frame, and counts the time towards the next steps.
+            step_time += clock.tick(FRAME_RATE) / 1000
             self.update_game()
-            self.window.fill((255, 255, 255))
-            last_position = self.position[:]
-            laser_cooldown -= 1
-            map_rects.clear()
+            if gui_stage == "game" and self.killed_by is not None:
+                self.reset_client()
+                gui_stage = "killed"
+            dirty_rects = None
 
             # get input
             if gui_stage == "game":
                 input = pygame.key.get_pressed()
-                if input[pygame.K_w]:
-                    self.position[1] -= 1
-                if input[pygame.K_s]:
-                    self.position[1] += 1
-                if input[pygame.K_a]:
-                    self.position[0] -= 1
-                if input[pygame.K_d]:
-                    self.position[0] += 1
-                if laser_cooldown <= 0:
-                    if input[pygame.K_UP]:
-                        self.sendplayerdata("w")
-                        laser_cooldown = 25
-                    elif input[pygame.K_DOWN]:
-                        self.sendplayerdata("s")
-                        laser_cooldown = 25
-                    elif input[pygame.K_LEFT]:
-                        self.sendplayerdata("a")
-                        laser_cooldown = 25
-                    elif input[pygame.K_RIGHT]:
-                        self.sendplayerdata("d")
-                        laser_cooldown = 25
-
-                # Player position reset if it is invalid
-                if not 5 <= self.position[0] <= 995 or not 5 <= self.position[1] <= 995:
-                    self.position = last_position[:]
-                client_rect = pygame.Rect(self.pos_to_coords([self.position[0] - 5, self.position[1] - 5], True), self.pos_to_coords([10, 10], False))
-                for pos in game_map:
-                    if client_rect.colliderect(pygame.Rect(self.pos_to_coords(pos[0], True), self.pos_to_coords(pos[1], False))):
+                steps = 0
+                while step_time >= 1 / STEP_RATE and steps < MAX_STEPS:
+                    step_time -= 1 / STEP_RATE
+                    steps += 1
+                    last_position = self.position[:]
+                    laser_cooldown -= 1
+                    if input[pygame.K_w]:
+                        self.position[1] -= 1
+                    if input[pygame.K_s]:
+                        self.position[1] += 1
+                    if input[pygame.K_a]:
+                        self.position[0] -= 1
+                    if input[pygame.K_d]:
+                        self.position[0] += 1
+                    if laser_cooldown <= 0:
+                        if input[pygame.K_UP]:
+                            self.sendplayerdata("w")
+                            laser_cooldown = 25
+                        elif input[pygame.K_DOWN]:
+                            self.sendplayerdata("s")
+                            laser_cooldown = 25
+                        elif input[pygame.K_LEFT]:
+                            self.sendplayerdata("a")
+                            laser_cooldown = 25
+                        elif input[pygame.K_RIGHT]:
+                            self.sendplayerdata("d")
+                            laser_cooldown = 25
+
+                    # Player position reset if it is invalid
+                    if not 5 <= self.position[0] <= 995 or not 5 <= self.position[1] <= 995:
+                        self.position = last_position[:]
+                    if self.collision_map.blocked(box(self.position, PLAYER_SIZE)):
                         self.position = last_position[:]
-                        break
-
-                # As the player's position should be valid:
-                if last_position != self.position:
-                    self.sendplayerdata("p")
 
-                # Render Walls
-                map_rects.clear()
-                for pos in game_map:
-                    map_rects.append(pygame.Rect(self.pos_to_coords(pos[0], True), self.pos_to_coords(pos[1], False)))
-                [pygame.draw.rect(self.window, (50, 50, 50), rect) for rect in map_rects]
+                    # As the player's position should be valid:
+                    if last_position != self.position:
+                        self.sendplayerdata("p")
+                if steps == MAX_STEPS:
+                    # Too far behind, the missed steps are dropped rather than run all at once.
+                    step_time = 0
+
+                # Render Walls, from the map layer drawn when the window was last resized
+                if self.map_layer_size != self.window_size:
+                    self.build_map_layer()
+                    last_camera = None
+                camera = tuple([int(-coordinate) for coordinate in self.pos_to_coords([0, 0], True)])
+                if camera != last_camera:
+                    self.window.blit(self.map_layer, (0, 0), pygame.Rect(camera, self.window_size))
+                else:
+                    for rect in drawn_rects:
+                        self.window.blit(self.map_layer, rect, rect.move(camera))
+                    dirty_rects = drawn_rects
+                last_camera = camera
+                drawn_rects = list()
 
                 # Render Other players
-                player_rects.clear()
+                fraction = self.render_fraction()
                 for player in self.players.values():
                     if player.status and player.health:
-                        player_rects.append(pygame.Rect(pygame.Rect(self.pos_to_coords([player.position[0] - 5, player.position[1] - 5], True), self.pos_to_coords([10, 10], False))))
-                        pygame.draw.rect(self.window, player.colour, pygame.Rect(self.pos_to_coords([player.position[0] - 5, player.position[1] - 5], True), self.pos_to_coords([10, 10], False)))
-                        self.display_text(player.name, 10, (0, 0, 0), self.pos_to_coords(player.position, True), "center", False)
+                        position = player.position_between(self.tick, fraction)
+                        drawn_rects.append(pygame.draw.rect(self.window, player.colour, pygame.Rect(self.pos_to_coords([position[0] - 5, position[1] - 5], True), self.pos_to_coords([10, 10], False))))
+                        drawn_rects.append(self.display_text(player.name, 10, (0, 0, 0), self.pos_to_coords(position, True), "center", False))
 
-                # Render Lasers and check laser
-                laser_rects.clear()
+                # Render Lasers (the server works out what they hit), a laser is not drawn behind where it was fired from
+                render_tick = self.previous_tick + (self.tick - self.previous_tick) * fraction
                 for laser in self.lasers.values():
-                    laser_rect = pygame.Rect(self.pos_to_coords([laser.position[0] - 1.5, laser.position[1] - 1.5], True), self.pos_to_coords([3, 3], False))
-                    if client_rect.colliderect(laser_rect) and laser.player_id in [player_obj.identity for player_obj in self.players.values()]:
-                        self.sendplayerdata("o" + laser.laser_id)
-                        self.health -= 1
-                        self.sendplayerdata("h")
-                        if self.health == 0:
-                            print("killed")
-                            self.sendplayerdata("k" + laser.player_id)
-                            if not killed_by:
-                                killed_by = self.players[laser.player_id].name
-                                print(killed_by)
-                            self.reset_client()
-                            gui_stage = "killed"
-                    if any([laser_rect.colliderect(map_rect) for map_rect in map_rects]):
-                        self.sendplayerdata("o" + laser.laser_id)
-                    laser_rects[laser.player_id] = laser_rect
-                    pygame.draw.rect(self.window, laser.colour, pygame.Rect(self.pos_to_coords(laser.position, True), self.pos_to_coords([3, 3], False)))
-
-                pygame.draw.rect(self.window, self.colour, pygame.Rect(self.pos_to_coords([self.position[0] - 5, self.position[1] - 5], True), self.pos_to_coords([10, 10], False)))
+                    drawn_rects.append(pygame.draw.rect(self.window, laser.colour, pygame.Rect(self.pos_to_coords(laser.position_at(max(render_tick, laser.spawn_tick)), True), self.pos_to_coords([3, 3], False))))
+
+                drawn_rects.append(pygame.draw.rect(self.window, self.colour, pygame.Rect(self.pos_to_coords([self.position[0] - 5, self.position[1] - 5], True), self.pos_to_coords([10, 10], False))))
 
                 if input[pygame.K_TAB]:
-                    self.display_text("NAME:", 15, (0, 0, 0), (0.1, 0.1), "center", True)
-                    self.display_text("HEALTH:", 15, (0, 0, 0), (0.2, 0.1), "center", True)
-                    self.display_text("KILLS:", 15, (0, 0, 0), (0.3, 0.1), "center", True)
+                    drawn_rects.append(self.display_text("NAME:", 15, (0, 0, 0), (0.1, 0.1), "center", True))
+                    drawn_rects.append(self.display_text("HEALTH:", 15, (0, 0, 0), (0.2, 0.1), "center", True))
+                    drawn_rects.append(self.display_text("KILLS:", 15, (0, 0, 0), (0.3, 0.1), "center", True))
                     kill_list = sorted(list(self.players.values()), key=lambda player_obj: player_obj.kills)
                     for item in kill_list:
-                        if not item.status:
+                        if not item.name:
                             kill_list.remove(item)
 
                     for index in range(0, len(kill_list)):
@@ -488,19 +769,21 @@ class Mainloop(Client):
                             break
                     for index in range(0, min(7, len(kill_list))):
                         if kill_list[index] == "CLIENT":
-                            self.display_text(self.name, 15, (255, 0, 0), (0.1, 0.2 + index * 0.1), "center", True)
-                            self.display_text(str(self.health), 15, (255, 0, 0), (0.2, 0.2 + index * 0.1), "center", True)
-                            self.display_text(str(self.kills), 15, (255, 0, 0), (0.3, 0.2 + index * 0.1), "center", True)
+                            drawn_rects.append(self.display_text(self.name, 15, (255, 0, 0), (0.1, 0.2 + index * 0.1), "center", True))
+                            drawn_rects.append(self.display_text(str(self.health), 15, (255, 0, 0), (0.2, 0.2 + index * 0.1), "center", True))
+                            drawn_rects.append(self.display_text(str(self.kills), 15, (255, 0, 0), (0.3, 0.2 + index * 0.1), "center", True))
                         else:
 
-                            self.display_text(kill_list[index].name, 15, (0, 0, 0), (0.1, 0.2 + index * 0.1), "center", True)
-                            self.display_text(str(kill_list[index].health), 15, (0, 0, 0), (0.2, 0.2 + index * 0.1), "center", True)
-                            self.display_text(str(kill_list[index].kills), 15, (0, 0, 0), (0.3, 0.2 + index * 0.1), "center", True)
+                            drawn_rects.append(self.display_text(kill_list[index].name, 15, (0, 0, 0), (0.1, 0.2 + index * 0.1), "center", True))
+                            drawn_rects.append(self.display_text(str(kill_list[index].health), 15, (0, 0, 0), (0.2, 0.2 + index * 0.1), "center", True))
+                            drawn_rects.append(self.display_text(str(kill_list[index].kills), 15, (0, 0, 0), (0.3, 0.2 + index * 0.1), "center", True))
 
 
             elif gui_stage == "killed":
+                last_camera = None
+                step_time = 0
                 self.window.fill((0, 0, 0))
-                self.display_text("YOU WERE KILLED BY: " + killed_by, 50, (255, 0, 0), (0.5, 0.3), "center", True)
+                self.display_text("YOU WERE KILLED BY: " + self.killed_by, 50, (255, 0, 0), (0.5, 0.3), "center", True)
                 respawn_button = self.create_textrect((0.3, 0.5), (0.4, 0.1), (0, 255, 0), True, "RESPAWN", 50, (255, 255, 255), True)
                 quit_button = self.create_textrect((0.3, 0.7), (0.4, 0.1), (0, 0, 255), True, "QUIT", 50, (255, 255, 255), True)
 
@@ -509,7 +792,9 @@ class Mainloop(Client):
                     if gui_stage == "killed":
                         if respawn_button.collidepoint(event.pos):
                             self.health = 10
+                            self.killed_by = None
                             self.sendplayerdata("h")
+                            self.sendplayerdata("p")
                             gui_stage = "game"
                         elif quit_button.collidepoint(event.pos):
                             self.disconnect()
@@ -521,7 +806,13 @@ class Mainloop(Client):
                     self.disconnect()
                     pygame.display.quit()
                     quit()
-            pygame.display.update()
+            # Everything this frame sent goes out together, before waiting on the display.
+            self.flush()
+            if dirty_rects is None:
+                pygame.display.update()
+            else:
+                # Last frame's rects cover what was drawn over, this frame's what is drawn now.
+                pygame.display.update(dirty_rects + drawn_rects)
 
 
 # TODO BUGS:
@@ -0,0 +1,246 @@
+# --==BLOCK BLASTR LOAD TEST==--
+# Puts a server under load with headless bots that speak the real protocol, without opening any pygame windows.
+# Every bot is an asyncio task with its own connection. Bots join with a name and colour, wander the map (checking the
+# walls the same way the game does), fire lasers at fire_rate a second, and respawn a second after being killed.
+#
+# REPORT
+#   server tick     How long the server's ticks take, from the server's own tick profile (its metrics endpoint, see
+#                   metrics.py), as percentiles over the last ticks it has published, along with how many ticks ran late
+#                   and how many times it skipped ticks while the bots were running. Only reported with --metrics-port,
+#                   which must be the port the server was started with.
+#   frame interval  The time between one frame and the next at each bot, as percentiles. At a steady tick rate these sit
+#                   at 1 / tick rate, anything above that is the server running late or the network or the bots holding
+#                   frames back, so this is what the bots see rather than what the server spends.
+#   bytes in / out  Per bot per second.
+#   frame loss      Snapshot numbers a bot never got a frame for, as a share of every frame it should have had. Frames
+#                   are lost when a server skips or drops updates for a client that is not keeping up.
+#
+# BOT CLASS
+# Attributes:   Type:       Description:
+#   identity        Integer     The id the server gave the bot.
+#
+#   position        List        Where the bot is.
+#
+#   alive           Boolean     False from when the bot is killed until it respawns.
+#
+#   bytes_in        Integer     Bytes received.
+#
+#   bytes_out       Integer     Bytes sent.
+#
+#   intervals       List        Seconds between each frame received and the one before it.
+#
+#   frames          Integer     Frames received.
+#
+#   lost            Integer     Snapshot numbers skipped between frames.
+#
+#   deaths          Integer     Times the bot was killed.
+#
+# Methods:      Parameters:     Description:
+#   run             host, port, duration    Connects and plays until duration seconds are up.
+#
+#   send            kind, *fields   Sends a message to the server.
+#
+#   receive         reader          Reads and handles everything the server sends.
+#
+#   play            N/A             Moves and fires at a fixed rate.
+#
+# RUNNING
+#   python server.py --headless --metrics-port 9100
+#   python loadtest.py --host 127.0.0.1 --port 6000 --metrics-port 9100 --bots 50 --duration 30 --fire-rate 1
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import urllib.request
+
+from world import GAME_MAP, PLAYER_SIZE, WORLD_SIZE, CollisionMap, box
+from protocol import CLIENT_MESSAGES, SERVER_MESSAGES, PROTOCOL_VERSION, FrameDecoder, ProtocolError
+
+# Bots move and decide whether to fire this many times a second, the same as the game's step rate.
+STEP_RATE = 60
+RESPAWN_DELAY = 1
+COLLISION_MAP = CollisionMap(GAME_MAP)
+
+
+def open_position():
+    while True:
+        position = [random.randint(5, WORLD_SIZE - 5), random.randint(5, WORLD_SIZE - 5)]
+        if not COLLISION_MAP.blocked(box(position, PLAYER_SIZE)):
+            return position
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    return sorted(values)[min(int(len(values) * share), len(values) - 1)]
+
+
+class Bot:
+    def __init__(self, number, fire_rate):
+        self.number = number
+        self.fire_rate = fire_rate
+        self.identity = None
+        self.position = open_position()
+        self.heading = random.choice("wasd")
+        self.alive = True
+        self.writer = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.intervals = list()
+        self.frames = 0
+        self.lost = 0
+        self.deaths = 0
+        self.last_frame = None
+        self.last_snapshot = None
+        self.frame_left = 0
+
+    async def run(self, host, port, duration):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.send("i", PROTOCOL_VERSION)
+        self.send("n", "bot" + str(self.number)[-5:])
+        self.send("c", random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        self.spawn()
+        tasks = [asyncio.create_task(self.receive(reader)), asyncio.create_task(self.play())]
+        await asyncio.wait(tasks, timeout=duration, return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            task.cancel()
+        try:
+            self.send("x")
+            self.writer.close()
+        except ConnectionError:
+            pass
+
+    def send(self, kind, *fields):
+        data = CLIENT_MESSAGES.encode(kind, *fields)
+        self.bytes_out += len(data)
+        self.writer.write(data)
+
+    def spawn(self):
+        self.position = open_position()
+        self.alive = True
+        self.send("h", 10)
+        self.send("p", *self.position)
+
+    async def receive(self, reader):
+        decoder = FrameDecoder(SERVER_MESSAGES)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                self.bytes_in += len(data)
+                for kind, fields in decoder.feed(data):
+                    self.handle(kind, fields)
+        except (ConnectionError, ProtocolError):
+            return
+
+    def handle(self, kind, fields):
+        if kind == "i":
+            self.identity = fields[1]
+        elif kind == "u":
+            now = time.perf_counter()
+            if self.last_frame is not None:
+                self.intervals.append(now - self.last_frame)
+                self.lost += max(fields[0] - self.last_snapshot - 1, 0)
+            self.last_frame = now
+            self.last_snapshot = fields[0]
+            self.frames += 1
+            self.frame_left = fields[2]
+            if not self.frame_left:
+                self.send("a", fields[0])
+        elif kind == "d":
+            if fields[0] == self.identity:
+                self.alive = False
+                self.deaths += 1
+                asyncio.get_running_loop().call_later(RESPAWN_DELAY, self.spawn)
+        elif kind not in ("t", "x", "y"):
+            # Part of a frame, which is acked once all of it has arrived.
+            self.frame_left -= 1
+            if self.frame_left == 0:
+                self.send("a", self.last_snapshot)
+
+    async def play(self):
+        step = 1 / STEP_RATE
+        next_step = time.perf_counter()
+        while True:
+            if self.alive:
+                if random.random() < 0.01:
+                    self.heading = random.choice("wasd")
+                moved = [self.position[0] + {"a": -1, "d": 1}.get(self.heading, 0), self.position[1] + {"w": -1, "s": 1}.get(self.heading, 0)]
+                if 5 <= moved[0] <= WORLD_SIZE - 5 and 5 <= moved[1] <= WORLD_SIZE - 5 and not COLLISION_MAP.blocked(box(moved, PLAYER_SIZE)):
+                    self.position = moved
+                    self.send("p", *self.position)
+                else:
+                    self.heading = random.choice("wasd")
+                if random.random() < self.fire_rate * step:
+                    self.send("l", random.choice("wasd"), *self.position)
+            next_step += step
+            await asyncio.sleep(max(next_step - time.perf_counter(), 0))
+
+
+def fetch_metrics(url):
+    with urllib.request.urlopen(url, timeout=1) as response:
+        return json.loads(response.read())
+
+
+async def watch_server(url, samples):
+    # The server publishes its metrics once a second, so they are fetched as often.
+    while True:
+        try:
+            samples.append(await asyncio.to_thread(fetch_metrics, url))
+        except (OSError, ValueError):
+            pass
+        await asyncio.sleep(1)
+
+
+async def swarm(host, port, bots, duration, fire_rate, ramp, metrics_port=None):
+    players = [Bot(number, fire_rate) for number in range(bots)]
+    samples = list()
+    watcher = None
+    if metrics_port:
+        watcher = asyncio.create_task(watch_server("http://" + host + ":" + str(metrics_port) + "/metrics.json", samples))
+    tasks = list()
+    for bot in players:
+        tasks.append(asyncio.create_task(bot.run(host, port, duration)))
+        # Joining gradually, so the report is not only the rush of connections.
+        await asyncio.sleep(ramp)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = len([result for result in results if isinstance(result, Exception)])
+    if watcher:
+        watcher.cancel()
+    return players, failed, [sample for sample in samples if sample.get("profile")]
+
+
+def report(players, failed, duration, samples):
+    intervals = [interval * 1000 for bot in players for interval in bot.intervals]
+    frames = sum([bot.frames for bot in players])
+    lost = sum([bot.lost for bot in players])
+    connected = [bot for bot in players if bot.frames]
+    print("bots: " + str(len(players)) + " (" + str(len(connected)) + " got frames, " + str(failed) + " failed)")
+    if samples:
+        first, last = samples[0], samples[-1]
+        tick = last["profile"]["tick"]
+        print("server tick ms (last %d ticks): p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (tick["count"], tick["p50"], tick["p90"], tick["p99"], tick["max"]))
+        print("server late ticks: %d  overruns: %d" % (last["profile"]["late_ticks"] - first["profile"]["late_ticks"], last["overruns"] - first["overruns"]))
+    print("frame interval at the bots ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (percentile(intervals, 0.5), percentile(intervals, 0.9), percentile(intervals, 0.99), max(intervals or [0])))
+    if connected:
+        print("bytes in per bot per second: %.0f" % (sum([bot.bytes_in for bot in connected]) / len(connected) / duration))
+        print("bytes out per bot per second: %.0f" % (sum([bot.bytes_out for bot in connected]) / len(connected) / duration))
+    print("frame loss: %.2f%% (%d of %d)" % (100 * lost / max(frames + lost, 1), lost, frames + lost))
+    print("deaths: " + str(sum([bot.deaths for bot in players])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLASTR load test, runs headless bots against a server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--bots", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30, help="seconds each bot plays for")
+    parser.add_argument("--fire-rate", type=float, default=1, help="lasers each bot fires a second")
+    parser.add_argument("--ramp", type=float, default=0.05, help="seconds between bots joining")
+    parser.add_argument("--metrics-port", type=int, help="the server's --metrics-port, to report its own tick times")
+    args = parser.parse_args()
+    players, failed, samples = asyncio.run(swarm(args.host, args.port, args.bots, args.duration, args.fire_rate, args.ramp, args.metrics_port))
+    report(players, failed, args.duration, samples)
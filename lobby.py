@@ -0,0 +1,247 @@
+# --==BLOCK BLASTR LOBBY==--
+# Runs many matches on one machine. The lobby is the only process listening for players, each match (an arena) is a
+# server.Server running in a process of its own, so arenas use as many cores as there are.
+#
+# HANDOFF
+# The lobby accepts every connection and passes the socket itself to an arena over a Unix socket pair, then forgets it.
+# From then on the client talks straight to the arena process, nothing is proxied through the lobby.
+# The same socket pair carries reports back to the lobby ("!IH"): how many sockets the arena has taken off the pair so
+# far, then its player count. One is sent for every socket taken and every player leaving, so each handoff is acked.
+#
+# BALANCING
+# A new player goes to the fullest arena that still has room, so matches fill up rather than spreading a few players
+# thinly over every arena. When every arena is full a new one is started, up to max_arenas. An arena that has been empty
+# for ARENA_IDLE seconds is shut down, as long as there is another one left.
+#
+# ARENA CLASS
+# The lobby's record of an arena process.
+# Attributes:   Type:       Description:
+#   process         Process     The arena's process.
+#
+#   control         Socket      The lobby's end of the socket pair, sockets are sent down it and player counts come back.
+#
+#   players         Integer     How many players are in the arena, as last reported plus any handed over that the
+#                               arena has not acked yet.
+#
+#   handoffs        Integer     How many sockets have been sent to the arena.
+#
+#   empty_since     Float       When the arena last became empty, None while it has players.
+#
+#   buffer          Bytes       Part of a report that has not fully arrived yet.
+#
+# ARENA SERVER CLASS
+# A server.Server that takes its players from the lobby instead of listening itself.
+# Attributes:   Type:       Description:
+#   handoffs        Integer     How many sockets have been taken from the lobby, acked with every report.
+#
+# Methods:      Parameters:     Description:
+#   accept_client   N/A             Takes a socket handed over by the lobby, stops the arena if the lobby has closed the pair.
+#
+#   add_player      client (Socket) Adds the player and reports, also when the arena is full, so the handoff is acked.
+#
+#   report          N/A             Tells the lobby how many sockets it has taken and how many players there are.
+#
+# LOBBY CLASS
+# Attributes:   Type:       Description:
+#   arenas          List        The running arenas.
+#
+#   arena_size      Integer     The most players in one arena (at most server.MAX_PLAYERS).
+#
+#   max_arenas      Integer     The most arenas running at once, one per core by default.
+#
+# Methods:      Parameters:     Description:
+#   start_arena     N/A             Starts a new arena process.
+#
+#   stop_arena      arena (Arena)   Shuts an arena down.
+#
+#   place_player    connection (Socket) Hands a new connection to an arena, closing it if every arena is full.
+#
+#   read_counts     arena (Arena)   Reads the reports an arena has sent, removing the arena if it has gone.
+#
+#   run             N/A             Accepts and places players until interrupted.
+#
+# RUNNING
+#   python lobby.py --host 0.0.0.0 --port 6000 --arena-size 16 --max-arenas 8
+
+import argparse
+import multiprocessing
+import os
+import select
+import socket
+import struct
+import time
+
+from server import MAX_PLAYERS, VIEW_RADIUS, Registry, Server, TickScheduler
+
+REPORT = struct.Struct("!IH")
+
+# Seconds an arena can sit empty before it is shut down.
+ARENA_IDLE = 30
+
+
+class ArenaServer(Server):
+    def __init__(self, control, arena_size, tick_rate=60, view_radius=VIEW_RADIUS):
+        Server.__init__(self, None, None, tick_rate, view_radius)
+        self.player_ids = Registry(arena_size)
+        # The handed over sockets arrive on the control socket, so it stands in for the listening socket in serve_clients.
+        self.server = control
+        self.handoffs = 0
+
+    def accept_client(self):
+        try:
+            # One byte at a time, each handed over socket comes with a byte of its own.
+            data, fds, flags, address = socket.recv_fds(self.server, 1, 1)
+        except OSError:
+            data, fds = b"", []
+        if not fds:
+            # The lobby has closed its end (or sent nothing usable), the arena is shutting down.
+            self.server_state = "OFFLINE"
+            return None
+        self.handoffs += 1
+        return socket.socket(fileno=fds[0])
+
+    def add_player(self, client):
+        client_id = Server.add_player(self, client)
+        # Reported even when the arena is full, the lobby still needs to know the socket arrived.
+        self.report()
+        return client_id
+
+    def remove_player(self, client_id):
+        Server.remove_player(self, client_id)
+        self.report()
+
+    def report(self):
+        try:
+            self.server.send(REPORT.pack(self.handoffs % 2 ** 32, len(self.players)))
+        except OSError:
+            pass
+
+
+def run_arena(control, arena_size, tick_rate, view_radius):
+    arena = ArenaServer(control, arena_size, tick_rate, view_radius)
+    arena.server_state = "CONNECTED"
+    scheduler = TickScheduler(arena.serve_clients, tick_rate)
+    try:
+        scheduler.run_forever(lambda: arena.server_state == "CONNECTED")
+    except KeyboardInterrupt:
+        pass
+    arena.stop_server()
+
+
+class Arena:
+    def __init__(self, process, control):
+        self.process = process
+        self.control = control
+        self.players = 0
+        self.handoffs = 0
+        self.empty_since = time.monotonic()
+        self.buffer = bytearray()
+
+
+class Lobby:
+    def __init__(self, hostname, port=6000, arena_size=16, max_arenas=None, tick_rate=60, view_radius=VIEW_RADIUS):
+        self.hostname = hostname
+        self.port = port
+        self.arena_size = min(arena_size, MAX_PLAYERS)
+        self.max_arenas = max_arenas or os.cpu_count() or 1
+        self.tick_rate = tick_rate
+        self.view_radius = view_radius
+        self.arenas = list()
+
+    def start_arena(self):
+        control, arena_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Spawned rather than forked, so an arena does not inherit the listening socket or the other arenas' sockets.
+        process = multiprocessing.get_context("spawn").Process(target=run_arena, args=(arena_control, self.arena_size, self.tick_rate, self.view_radius), daemon=True)
+        process.start()
+        arena_control.close()
+        arena = Arena(process, control)
+        self.arenas.append(arena)
+        return arena
+
+    def stop_arena(self, arena):
+        self.arenas.remove(arena)
+        arena.control.close()
+        arena.process.join(1)
+
+    def place_player(self, connection):
+        open_arenas = [arena for arena in self.arenas if arena.players < self.arena_size]
+        if open_arenas:
+            arena = max(open_arenas, key=lambda arena: arena.players)
+        elif len(self.arenas) < self.max_arenas:
+            arena = self.start_arena()
+        else:
+            connection.close()
+            return
+        try:
+            socket.send_fds(arena.control, [b"c"], [connection.fileno()])
+            arena.handoffs += 1
+            arena.players += 1
+            arena.empty_since = None
+        except OSError:
+            pass
+        # The arena has its own copy of the socket now.
+        connection.close()
+
+    def read_counts(self, arena):
+        try:
+            data = arena.control.recv(REPORT.size * 64)
+        except OSError:
+            data = b""
+        if not data:
+            # The arena process has gone.
+            self.arenas.remove(arena)
+            arena.control.close()
+            return
+        # Only the newest report matters. A read can end part way through a report, so the rest waits in the buffer.
+        arena.buffer += data
+        whole = len(arena.buffer) - len(arena.buffer) % REPORT.size
+        if whole:
+            acked, players = REPORT.unpack_from(arena.buffer, whole - REPORT.size)
+            del arena.buffer[:whole]
+            # Sockets still on their way are not in the arena's count yet, they are counted until the arena acks them.
+            arena.players = players + (arena.handoffs - acked) % 2 ** 32
+            if arena.players == 0 and arena.empty_since is None:
+                arena.empty_since = time.monotonic()
+            elif arena.players:
+                arena.empty_since = None
+
+    def run(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.hostname, self.port))
+        listener.listen(128)
+        self.start_arena()
+        print("Lobby running at " + self.hostname + ":" + str(self.port) + ", up to " + str(self.max_arenas) + " arenas of " + str(self.arena_size) + " players")
+        try:
+            while True:
+                readable, writable, exceptions = select.select([listener] + [arena.control for arena in self.arenas], [], [], 1)
+                for event in readable:
+                    if event is listener:
+                        connection, ip = listener.accept()
+                        self.place_player(connection)
+                    else:
+                        for arena in self.arenas:
+                            if arena.control is event:
+                                self.read_counts(arena)
+                                break
+                now = time.monotonic()
+                for arena in list(self.arenas):
+                    if len(self.arenas) > 1 and arena.empty_since is not None and now - arena.empty_since > ARENA_IDLE:
+                        self.stop_arena(arena)
+        except KeyboardInterrupt:
+            pass
+        for arena in list(self.arenas):
+            self.stop_arena(arena)
+        listener.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLASTR lobby, runs a server process per arena")
+    parser.add_argument("--host", default="0.0.0.0", help="hostname or IP address to listen on")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--arena-size", type=int, default=16, help="most players in one arena")
+    parser.add_argument("--max-arenas", type=int, default=None, help="most arenas at once, defaults to one per core")
+    parser.add_argument("--tick-rate", type=int, default=60, help="simulation ticks per second in each arena")
+    parser.add_argument("--view-radius", type=int, default=VIEW_RADIUS, help="how far from a player things are sent to them, 0 for the whole map")
+    args = parser.parse_args()
+    Lobby(args.host, args.port, args.arena_size, args.max_arenas, args.tick_rate, args.view_radius).run()
@@ -0,0 +1,143 @@
+# --==BLOCK BLASTR METRICS==--
+# Finds where a server's ticks spend their time. Nothing in here runs unless it is switched on (server.Server.enable_metrics),
+# a server without it only checks that its profiler is None once per phase.
+#
+# PHASES
+# Every tick is split into phases by calling mark at the end of each one, the time since the last mark goes to that phase.
+# The last window durations of each phase (and of whole ticks) are kept, so the numbers always cover the last few seconds.
+# A tick taking longer than the tick interval counts as late.
+#
+# ENDPOINT
+# The server publishes its metrics once a second. MetricsEndpoint serves the newest ones over HTTP on its own thread:
+#   /metrics            plain text, one "name{labels} value" line each (the Prometheus text format).
+#   /metrics.json       the same as JSON.
+# It only ever reads the published copy, so it never touches the game while a tick is running.
+#
+# TICK PROFILER CLASS
+# Attributes:   Type:       Description:
+#   interval        Float       Seconds between ticks, a tick longer than this is late.
+#
+#   phases          Dict        The recent durations of each phase, {...name : deque([seconds, ...]),...}
+#
+#   ticks           Deque       The recent durations of whole ticks.
+#
+#   late            Integer     The number of late ticks.
+#
+# Methods:      Parameters:     Description:
+#   start           N/A             Starts timing a tick.
+#
+#   mark            phase (String)  Ends a phase, giving it the time since the last mark.
+#
+#   finish          N/A             Ends the tick.
+#
+#   summary         N/A             Gives the percentiles and histogram of each phase and of whole ticks, in milliseconds.
+#
+# METRICS ENDPOINT CLASS
+# Methods:      Parameters:     Description:
+#   start           N/A             Starts serving on a daemon thread.
+#
+#   stop            N/A             Stops serving.
+
+import json
+import time
+import _thread as thread
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy
+
+# Histogram bucket upper edges in milliseconds.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+
+
+def describe(durations):
+    milliseconds = numpy.fromiter(durations, float, len(durations)) * 1000
+    if not len(milliseconds):
+        return {"count": 0}
+    p50, p90, p99 = numpy.percentile(milliseconds, (50, 90, 99))
+    counts = numpy.histogram(milliseconds, (0,) + BUCKETS + (numpy.inf,))[0]
+    return {"count": len(milliseconds), "mean": float(milliseconds.mean()), "p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "max": float(milliseconds.max()), "histogram": dict(zip([str(edge) for edge in BUCKETS] + ["inf"], counts.tolist()))}
+
+
+class TickProfiler:
+    def __init__(self, interval, window=600):
+        self.interval = interval
+        self.window = window
+        self.phases = dict()
+        self.ticks = deque(maxlen=window)
+        self.late = 0
+        self.tick_start = 0
+        self.last = 0
+
+    def start(self):
+        self.tick_start = self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        durations = self.phases.get(phase)
+        if durations is None:
+            durations = self.phases[phase] = deque(maxlen=self.window)
+        durations.append(now - self.last)
+        self.last = now
+
+    def finish(self):
+        duration = time.perf_counter() - self.tick_start
+        self.ticks.append(duration)
+        if duration > self.interval:
+            self.late += 1
+
+    def summary(self):
+        return {"tick": describe(self.ticks), "late_ticks": self.late, "phases": {phase: describe(durations) for phase, durations in self.phases.items()}}
+
+
+def format_text(metrics):
+    # Flattens the metrics into "name{labels} value" lines.
+    lines = list()
+    for name in ("tick", "players", "lasers", "overruns", "dropped"):
+        lines.append("blastr_" + name + " " + str(metrics.get(name, 0)))
+    profile = metrics.get("profile")
+    if profile:
+        lines.append("blastr_late_ticks " + str(profile["late_ticks"]))
+        for phase, summary in [("tick", profile["tick"])] + sorted(profile["phases"].items()):
+            for statistic in ("p50", "p90", "p99", "max"):
+                if statistic in summary:
+                    lines.append('blastr_phase_ms{phase="' + phase + '",stat="' + statistic + '"} %.4f' % summary[statistic])
+    for client_id, client in sorted(metrics.get("clients", dict()).items()):
+        for name, value in sorted(client.items()):
+            lines.append('blastr_client_' + name + '{client="' + str(client_id) + '"} ' + str(value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    def __init__(self, server, hostname="127.0.0.1", port=9100):
+        self.server = server
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                metrics = endpoint.server.metrics_snapshot
+                if self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics).encode(), "application/json"
+                elif self.path == "/metrics":
+                    body, content_type = format_text(metrics).encode(), "text/plain"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = HTTPServer((hostname, port), Handler)
+
+    def start(self):
+        thread.start_new_thread(self.http.serve_forever, ())
+
+    def stop(self):
+        self.http.shutdown()
+        self.http.server_close()
@@ -0,0 +1,222 @@
+# --==BLOCK BLASTR WIRE PROTOCOL==--
+# Shared by the server and the client, so both ends always agree on the message layout.
+#
+# FRAMING
+# Every message is a frame: a 3 byte header followed by a payload of struct packed fields (network byte order).
+#   header          "!BH"               message type (the command letter as a byte), payload length in bytes
+#
+# A TCP read can end part way through a frame or hold several frames, so each end keeps a FrameDecoder per connection
+# which holds on to any unfinished frame until the rest of it arrives.
+#
+# RECEIVING
+# Each read is copied onto the end of a bytearray the FrameDecoder keeps for the whole connection, and messages are
+# unpacked from where they sit in it. It is a linear buffer rather than a ring: decoding moves the start along, once
+# everything read has been decoded both ends go back to the front, and otherwise the unfinished frame is moved back to the
+# front when there is no room left after it. Reading with recv_into straight into the buffer measured no faster than
+# recv and a copy (see bench.py), so sockets are read with recv.
+#
+# The first frame in each direction is a hello carrying PROTOCOL_VERSION, a connection speaking another version is dropped.
+# Bump PROTOCOL_VERSION whenever a format below changes.
+#
+# CLIENT --> SERVER
+#   hello           "i"     "!B"        version
+#   name            "n"     "!8s"       name, padded with null bytes
+#   colour          "c"     "!3B"       red, green, blue
+#   health          "h"     "!B"        health, only taken while respawning (the server sets it to MAX_HEALTH)
+#   position        "p"     "!hh"       x, y
+#   closing         "x"     ""          N/A
+#   new laser       "l"     "!chh"      direction (w, a, s or d), x, y (the server fires from its own copy of the position)
+#   snapshot ack    "a"     "!I"        number of the last snapshot the client has, 0 asks for everything again
+#
+# SERVER --> CLIENT
+#   hello           "i"     "!BB"       version, id given to the client
+#   name            "n"     "!B8s"      player id, name
+#   colour          "c"     "!B3B"      player id, red, green, blue
+#   health          "h"     "!BB"       player id, health
+#   position        "p"     "!Bhh"      player id, x, y
+#   kills           "k"     "!BH"       player id, kills
+#   player gone     "z"     "!B"        player id
+#   out of view     "q"     "!B"        player id
+#   closing         "x"     ""          N/A
+#   udp channel     "y"     "!IH"       token, UDP port (a token of 0 means the channel is closed, send everything over TCP)
+#   new frame       "u"     "!III"      snapshot number, baseline snapshot number (0 for none), number of messages in the frame
+#   laser spawn     "v"     "!HBB3BhhcI"    laser id, laser generation, player id, red, green, blue, origin x, origin y,
+#                                           direction (w, a, s or d), spawn tick
+#   laser gone      "o"     "!H"        laser id
+#   hit             "t"     "!BBB"      id of the player hit, id of the player that fired the laser, health left
+#   death           "d"     "!BB"       id of the player killed, id of the killer (NO_PLAYER if they have left)
+#
+# LASERS
+# A laser never changes once fired, so it is sent once as a laser spawn and once as laser gone. Snapshot numbers are
+# server ticks, and each end works out where a laser is on a tick with world.laser_position. A laser is at its origin on
+# its spawn tick and moves LASER_SPEED in its direction every tick after.
+#
+# HITS
+# The server decides every laser hit. Hits are sent only to the player hit, deaths to everyone. Neither is part of a
+# snapshot, they are sent once alongside the next frame.
+#
+# SNAPSHOTS
+# Every tick the server numbers a snapshot of the world. A new frame holds only what differs between that snapshot and
+# the baseline, the last snapshot the client acked. Changed player fields are sent as name, colour, health, position and
+# kills messages, new lasers as laser spawns, and entities missing from the new snapshot as player gone and laser gone.
+# The client rebuilds the new snapshot by applying the frame to its copy of the baseline, so it keeps the last
+# SNAPSHOT_HISTORY snapshots. A baseline of 0 (a client that has acked nothing or fell too far behind) is a full resync.
+#
+# AREA OF INTEREST
+# Each client's snapshots only hold what is near its player's last known position (see view_radius in server.py).
+# Lasers further away are left out, so they come and go as laser spawns and laser gone when they cross the edge.
+# Players further away are kept, as names, health and kills are still shown, but without their position: leaving the area
+# is an out of view message and coming back into it a position message.
+#
+# UDP CHANNEL
+# A server started with UDP offers a side channel with a udp channel message straight after its hello. Anything that is
+# superseded by the next of its kind can go over it instead of TCP, so that a lost packet only loses that update rather
+# than holding up everything behind it:
+#   CLIENT --> SERVER   positions and snapshot acks. Each datagram is DATAGRAM_HEADER, "!II": token, sequence number,
+#                       followed by messages framed as above. The server drops any datagram not newer than the last.
+#   SERVER --> CLIENT   frames, one whole frame to a datagram. The client drops any frame older than the newest it has.
+# The server sends frames over UDP once a datagram with the right token has told it where the client is, and only if the
+# frame fits in MAX_DATAGRAM, otherwise it goes over TCP as usual. Everything else (hellos, names, lasers fired, hits,
+# deaths, closing) stays on TCP. A client that never sends a datagram just stays on TCP. If the client stops acking
+# over UDP the server closes the channel (a udp channel message with a token of 0) and goes back to TCP. The time allowed
+# (UDP_TIMEOUT in server.py) runs from the offer, so a client has to ack from the moment it connects, before it has
+# joined the game as well as after, or the channel is closed before it is ever used.
+#
+# GENERATIONS
+# Ids are reused once freed, so each laser also carries the generation of its id (the low byte of it), which tells it
+# apart from an earlier laser that had the same id.
+#
+# Text fields ("s" and "c" formats) are given and returned as strings, every other field as an integer.
+
+import struct
+
+PROTOCOL_VERSION = 7
+
+# Stands in for a player id when there is no player.
+NO_PLAYER = 255
+
+SNAPSHOT_HISTORY = 64
+
+# The most read from a socket at once, and the starting size of each connection's receive buffer.
+READ_SIZE = 4096
+RECEIVE_BUFFER = 1 << 16
+
+# The largest datagram sent over the UDP channel, small enough not to be fragmented on most networks.
+MAX_DATAGRAM = 1200
+DATAGRAM_HEADER = struct.Struct("!II")
+
+# The order of a player's fields in a snapshot.
+PLAYER_FIELDS = ("c", "n", "p", "h", "k")
+
+HEADER = struct.Struct("!BH")
+
+CLIENT_FORMATS = {"i": "!B", "n": "!8s", "c": "!3B", "h": "!B", "p": "!hh", "x": "!", "l": "!chh", "a": "!I"}
+
+SERVER_FORMATS = {"i": "!BB", "n": "!B8s", "c": "!B3B", "h": "!BB", "p": "!Bhh", "k": "!BH", "z": "!B", "q": "!B", "x": "!", "y": "!IH", "u": "!III",
+                  "v": "!HBB3BhhcI", "o": "!H", "t": "!BBB", "d": "!BB"}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class MessageSet:
+    def __init__(self, formats):
+        # Payload structs for decoding, and header + payload structs so a whole frame is packed in one call.
+        self.payloads = dict()
+        self.frames = dict()
+        self.text = set()
+        for kind, fmt in formats.items():
+            self.payloads[ord(kind)] = struct.Struct(fmt)
+            self.frames[kind] = struct.Struct(HEADER.format + fmt[1:])
+            if "s" in fmt or "c" in fmt[1:]:
+                self.text.add(kind)
+
+    def encode(self, kind, *fields):
+        if kind in self.text:
+            fields = [field.encode() if isinstance(field, str) else field for field in fields]
+        frame = self.frames[kind]
+        return frame.pack(ord(kind), frame.size - HEADER.size, *fields)
+
+    def decode(self, kind, buffer, offset, size):
+        try:
+            payload = self.payloads[kind]
+        except KeyError:
+            raise ProtocolError("unknown message type " + str(kind))
+        if payload.size != size:
+            raise ProtocolError("bad length " + str(size) + " for message " + chr(kind))
+        fields = payload.unpack_from(buffer, offset)
+        kind = chr(kind)
+        if kind in self.text:
+            fields = tuple(field.rstrip(b"\0").decode(errors="replace") if isinstance(field, bytes) else field for field in fields)
+        return kind, fields
+
+    def decode_all(self, data):
+        # For a datagram, which only ever holds whole messages.
+        messages = list()
+        offset = 0
+        while offset < len(data):
+            if len(data) - offset < HEADER.size:
+                raise ProtocolError("message cut short")
+            kind, size = HEADER.unpack_from(data, offset)
+            if len(data) - offset - HEADER.size < size:
+                raise ProtocolError("message cut short")
+            messages.append(self.decode(kind, data, offset + HEADER.size, size))
+            offset += HEADER.size + size
+        return messages
+
+
+CLIENT_MESSAGES = MessageSet(CLIENT_FORMATS)
+SERVER_MESSAGES = MessageSet(SERVER_FORMATS)
+
+
+class FrameDecoder:
+    def __init__(self, messages, size=RECEIVE_BUFFER):
+        self.messages = messages
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # The data read but not decoded yet is buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def reserve(self, size):
+        # Makes room for size more bytes after end.
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            buffer = bytearray(max(pending + size, len(self.buffer) * 2))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # Only ever the start of one frame, moved back to the front.
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.decode()
+
+    def decode(self):
+        # Returns every complete message as (kind, fields), anything left over waits for the next read.
+        buffer = self.buffer
+        messages = list()
+        offset = self.start
+        end = self.end
+        while end - offset >= HEADER.size:
+            kind, size = HEADER.unpack_from(buffer, offset)
+            if end - offset - HEADER.size < size:
+                break
+            messages.append(self.messages.decode(kind, buffer, offset + HEADER.size, size))
+            offset += HEADER.size + size
+        if offset == end:
+            # Everything has been decoded, the next read can start from the front again.
+            self.start = self.end = 0
+        else:
+            self.start = offset
+        return messages
@@ -0,0 +1,127 @@
+# --==BLOCK BLASTR MATCH RECORDING==--
+# Records everything a server's clients send it, so a match can be played back through a headless server (replay.py).
+# The game only changes through what clients send and the ticks themselves, so feeding the same reads into the same
+# ticks rebuilds the same match.
+#
+# FILE FORMAT
+# A header, HEADER: "BLASTREC", the format version, PROTOCOL_VERSION, tick_rate, view_radius, then the length ("!H") of
+# the server's rate_limits as JSON and the JSON itself.
+# Then entries, each an ENTRY: tick, kind, player id, length, followed by length bytes of data.
+# Kinds:
+#   joined          "j"     A client connected and was given the player id.
+#   data            "d"     One read from a client, exactly as it came off the socket.
+#   datagram        "u"     The messages in a datagram from a client's UDP channel, once it has been let through.
+#   left            "x"     The player was removed.
+#   world           "w"     The world was updated for the next tick.
+#   snapshot        "s"     A snapshot was taken. The data is a CRC32 of the snapshot (STATE), to check a replay against.
+# Entries are in the order the server handled them.
+#
+# WRITING
+# Entries are packed into a buffer during the tick, and at each snapshot the buffer is handed to a writer thread.
+# The tick never waits on the disk, it only packs a few bytes per read.
+#
+# RECORDER CLASS
+# Attributes:   Type:       Description:
+#   pending         Bytes       Entries packed since the last snapshot.
+#
+#   queue           Queue       Buffers waiting for the writer thread, None to stop it.
+#
+#   size            Integer     Bytes handed to the writer so far, including the header.
+#
+# Methods:      Parameters:     Description:
+#   record          tick, kind, player_id, data     Packs an entry.
+#
+#   flush           N/A             Hands the entries packed so far to the writer thread.
+#
+#   close           N/A             Flushes and waits for everything to be written.
+
+import json
+import queue
+import struct
+import threading
+import zlib
+
+import numpy
+
+from protocol import PROTOCOL_VERSION
+
+MAGIC = b"BLASTREC"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("!8sBBHH")
+LIMITS = struct.Struct("!H")
+ENTRY = struct.Struct("!IcBH")
+STATE = struct.Struct("!I")
+BUFFER_SIZE = 1 << 16
+
+
+class RecordingError(Exception):
+    pass
+
+
+def state_checksum(server):
+    # Covers what every client is shown: the state of each ready player and where each laser is.
+    checksum = zlib.crc32(repr(sorted(server.player_states.items())).encode())
+    return zlib.crc32(numpy.ascontiguousarray(server.laser_positions).tobytes(), checksum)
+
+
+class Recorder:
+    def __init__(self, path, tick_rate, view_radius, rate_limits):
+        self.file = open(path, "wb", buffering=BUFFER_SIZE)
+        limits = json.dumps(rate_limits).encode()
+        self.pending = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, PROTOCOL_VERSION, tick_rate, view_radius) + LIMITS.pack(len(limits)) + limits)
+        self.size = 0
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def record(self, tick, kind, player_id=0, data=b""):
+        self.pending += ENTRY.pack(tick, kind, player_id, len(data))
+        self.pending += data
+
+    def flush(self):
+        if self.pending:
+            self.size += len(self.pending)
+            self.queue.put(self.pending)
+            self.pending = bytearray()
+
+    def write_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            self.file.write(data)
+        self.file.close()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+
+
+def read_recording(path):
+    # Gives the header, (tick_rate, view_radius, rate_limits), and a generator of (tick, kind, player id, data) entries.
+    file = open(path, "rb", buffering=BUFFER_SIZE)
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise RecordingError("not a recording: " + path)
+    magic, version, protocol_version, tick_rate, view_radius = HEADER.unpack(header)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise RecordingError("not a recording: " + path)
+    if protocol_version != PROTOCOL_VERSION:
+        raise RecordingError("recorded with protocol version " + str(protocol_version) + ", this is version " + str(PROTOCOL_VERSION))
+    length = LIMITS.unpack(file.read(LIMITS.size))[0]
+    rate_limits = {kind: tuple(limit) for kind, limit in json.loads(file.read(length)).items()}
+
+    def entries():
+        with file:
+            while True:
+                head = file.read(ENTRY.size)
+                if len(head) < ENTRY.size:
+                    # The end, or a server that stopped part way through writing an entry.
+                    return
+                tick, kind, player_id, length = ENTRY.unpack(head)
+                data = file.read(length)
+                if len(data) < length:
+                    return
+                yield tick, kind, player_id, data
+    return (tick_rate, view_radius, rate_limits), entries()
@@ -0,0 +1,139 @@
+# --==BLOCK BLASTR REPLAY==--
+# Plays a recorded match (see recording.py) back through a headless server.Server as fast as it will go, without any
+# sockets. Each recorded read is fed to receive_data between the same world update and snapshot it arrived in, so the
+# replayed match is the one that was recorded: every snapshot is checked against the checksum recorded with it, and the
+# first tick that differs is reported.
+# Every tick builds an update for every client just as a live server does, so a replay is also a repeatable workload for
+# timing changes to the tick (--profile).
+#
+# REPORT
+#   ticks               Ticks replayed, and how much faster than the recorded tick rate they ran.
+#   reads               Client reads fed to the server.
+#   bytes out           Bytes the server would have sent.
+#   state               "matches the recording", or the first tick whose snapshot differs.
+#   players             Everyone still in the match at the end, with their health, kills and position.
+#
+# RUNNING
+#   python replay.py match.rec                          Plays the whole match back.
+#   python replay.py match.rec --until 3600 --profile   Stops at tick 3600, showing how long each phase of a tick took.
+
+import argparse
+import time
+
+from protocol import ProtocolError
+from recording import STATE, read_recording, state_checksum
+from server import Server
+
+
+class Connection:
+    # Stands in for a client socket, everything sent to it is counted and thrown away.
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def send_updates(server):
+    # The output phase of a tick, for every client as if every socket were writable.
+    for player in list(server.players.values()):
+        player.outbox += player.events
+        player.outbox += server.build_update(player)
+        player.events.clear()
+        player.updates_out += 1
+        player.bytes_out += player.connection.send(player.outbox)
+        player.outbox.clear()
+
+
+def replay(path, until=None, profile=False):
+    (tick_rate, view_radius, rate_limits), entries = read_recording(path)
+    server = Server(None, None, tick_rate, view_radius, rate_limits=rate_limits)
+    if profile:
+        server.enable_metrics()
+    profiler = server.profiler
+    # The connection standing in for each recorded player id.
+    connections = dict()
+    reads = 0
+    bytes_out = 0
+    diverged = None
+    start = time.perf_counter()
+    for tick, kind, player_id, data in entries:
+        if kind == b"w":
+            if until is not None and tick >= until:
+                break
+            if profiler:
+                profiler.start()
+            server.update_world()
+        elif kind == b"d":
+            client_id = server.sock_to_id(connections.get(player_id))
+            if client_id is None:
+                continue
+            reads += 1
+            try:
+                server.receive_data(client_id, data)
+            except ProtocolError:
+                # The recording goes on to remove them.
+                pass
+        elif kind == b"u":
+            client_id = server.sock_to_id(connections.get(player_id))
+            if client_id is not None:
+                reads += 1
+                server.receive_datagram(client_id, data)
+        elif kind == b"j":
+            connections[player_id] = Connection()
+            server.add_player(connections[player_id])
+        elif kind == b"x":
+            client_id = server.sock_to_id(connections.get(player_id))
+            if client_id is not None:
+                server.remove_player(client_id)
+            bytes_out += connections.pop(player_id).sent
+        elif kind == b"s":
+            if profiler:
+                profiler.mark("input")
+            server.take_snapshot()
+            if profiler:
+                profiler.mark("snapshot")
+            if diverged is None and STATE.unpack(data)[0] != state_checksum(server):
+                diverged = server.tick
+            send_updates(server)
+            if profiler:
+                profiler.mark("output")
+                profiler.finish()
+    elapsed = time.perf_counter() - start
+    bytes_out += sum([connection.sent for connection in connections.values()])
+    return server, {"ticks": server.tick, "seconds": elapsed, "speed": server.tick / tick_rate / max(elapsed, 1e-9),
+                    "reads": reads, "bytes_out": bytes_out, "diverged": diverged}
+
+
+def report(server, result):
+    print("ticks: %d in %.2f s (%.1fx real time)" % (result["ticks"], result["seconds"], result["speed"]))
+    print("reads: " + str(result["reads"]))
+    print("bytes out: " + str(result["bytes_out"]))
+    if result["diverged"] is None:
+        print("state: matches the recording")
+    else:
+        print("state: differs from the recording from tick " + str(result["diverged"]))
+    print("players:")
+    for player in server.players.values():
+        if player.status:
+            print("  %2d %-16s health %2d  kills %3d  at %s" % (player.identity, player.properties["n"], player.properties["h"], player.properties["k"], player.properties["p"]))
+    if server.profiler:
+        profile = server.profiler.summary()
+        print("phase ms:       p50       p90       p99       max")
+        for phase, summary in list(profile["phases"].items()) + [("tick", profile["tick"])]:
+            if summary["count"]:
+                print("  %-10s %9.4f %9.4f %9.4f %9.4f" % (phase, summary["p50"], summary["p90"], summary["p99"], summary["max"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLASTR replay, plays a recorded match back through a headless server")
+    parser.add_argument("path", help="a recording made with server.py --record")
+    parser.add_argument("--until", type=int, help="stop at this tick")
+    parser.add_argument("--profile", action="store_true", help="time each phase of every tick")
+    args = parser.parse_args()
+    server, result = replay(args.path, args.until, args.profile)
+    report(server, result)
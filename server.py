@@ -1,62 +1,174 @@
 # --==BLOCK BLASTR BY OLIVER KILLANE==--
 # GAME DESCRIPTION AND CODE EXPLANATION:
 # SERVER PROTOCOLS
-# all messages are in chunks, each with a + either side, to client has id between + and command.
+# All messages are length prefixed binary frames, the formats are listed in protocol.py.
+# Messages about a player sent to clients have the player's id as their first field.
 # Types:
-#   name            "+n12345678"        e.g. "+nOliver  "
-#   colour          "+c123123123"       e.g. "+c000225000"
-#   health          "+h123"             e.g. "+h012"
-#   position        "+p12341234"        e.g. "+p01231445"
-#   closing         "+x"                N/A
-#   new frame       "+u"                N/A
-#   new laser       "+lw12341234"       e.g. "+ls06000800"
-#   laser update    "+v1231212341234"   e.g. "+v0010206000880"
-#   laser gone      "+o123"             e.g. "+o002"
-#   player gone     "+z"                e.g. "+z01"
-#   player killed   "+k12"              e.g. "+k00"
+#   hello           "i"
+#   name            "n"
+#   colour          "c"
+#   health          "h"
+#   position        "p"
+#   closing         "x"
+#   new frame       "u"
+#   new laser       "l"
+#   laser spawn     "v"
+#   laser gone      "o"
+#   player gone     "z"
+#   out of view     "q"
+#   kills           "k"
+#   hit             "t"
+#   death           "d"
 #
 # DATA HANDLING
+#   Hello:              Server --> Client (client's id added) and Client --> Server, when the client connects
 #   Player Position:    Client --> Server (id added) --> Other Clients
 #   Player Name:        Client --> Server (id added) --> Other Clients
 #   Player Colour:      Client --> Server (processed for display only) (id added) --> Other Clients
-#   Health:             Client --> Server (id added) --> Other Clients
+#   Health:             Client --> Server (on respawn, the server sets it to MAX_HEALTH) or Server (on a hit) (id added) --> Other Clients
+#   Kills:              Server (on a kill) (id added) --> Other Clients
 #   Closing:            Client --> Server -->Other Clients or Server --> Client then Server --> Other Clients
-#   New Laser:          Client --> Server (processed continuously) --> All Clients (continuously)
-#   Laser Update:       Server (removes direction) --> All Clients
-#   Laser Gone:         Client --> Server --> All Clients
+#   New Laser:          Client --> Server (fired from where the server has the player) --> All Clients (continuously)
+#   Laser Spawn:        Server --> All Clients, once when the laser is fired (or comes into the client's area of interest)
+#   Laser Gone:         Server --> All Clients
+#   Hit:                Server --> Client hit
+#   Death:              Server --> All Clients
 #   Player Gone:        Client --> Server --> All Clients or Server --> All Clients
+#   Out Of View:        Server --> Clients whose area of interest the player has left
+#   Snapshot Ack:       Client --> Server, after each complete frame
 #
 # PLAYER OBJECT
 # An object containing all information on a player.
 # Attributes:   Type:   Description:
 #   properties      Dict    Holds all of the information other clients require in a dictionary:
-#                           self.properties = {"c": string, "n": string, "p": string, "h": string, "k": int}
+#                           self.properties = {"c": (int, int, int), "n": string, "p": (int, int), "h": int, "k": int}
+#                           A property is None until the client has sent it.
+#
+#   versions        Dict    The version each property last changed at, {...kind : version,...} in PLAYER_FIELDS order.
+#                           Versions come from one counter for every player (VERSIONS), so they only ever go up, even
+#                           when an id is reused.
+#
+#   version         Integer The newest of versions, so an unchanged player is one number compared.
+#
+#   detail_version  Integer The newest version of the properties other than position, all a client is sent of a player
+#                           out of its view.
+#
+#   messages        Dict    The encoded message for each property, made the first time it is sent and kept until the
+#                           property changes, so every client that is sent it shares the one encoding.
+#
+#   full_messages   Dict    Every property's message joined together, with the position in view (True) or out of view
+#                           (False), kept until any property changes.
+#
+#   out_of_view     Bytes   The out of view message for the player.
 #
 #   colour_format   Tuple   Holds a tuple with the information for the player's colour that pygame can display:
 #                           (int, int, int)
 #
-#   identity        String  The identity of the player within the game, denoted by its key within the self.players dictionary
-#                           Identity is a 2 character string of numbers (from 0 to 99).
+#   identity        Integer The identity of the player within the game, denoted by its key within the self.players dictionary
+#                           Identity is a number from 0 to 98.
 #
 #   connection      Socket  Holds the socket.socket object that is used to communicate with this client from.
 #
-#   update          Dict    Contains all the players that the client needs to be updated on and the attributes that need updating
-#                           update = {...player_id : [attribute, e.g "p","n"], ...}
+#   decoder         Object  The FrameDecoder holding any part of a message that has not fully arrived yet.
+#
+#   outbox          Bytes   Data waiting to be sent to the client, kept between ticks when the socket only takes part of it.
+#
+#   events          Bytes   Hit and death events waiting to go out with the client's next update.
+#
+#   acked           Integer The number of the last snapshot the client has acked, 0 if it needs a full resync.
+#
+#   views           Dict    The recent snapshots sent to the client by number, each only holding what was in its area of interest
+#                           (see view_of).
+#
+#   view_position   Tuple   The last position the client sent, kept while they are dead. The centre of their area of interest.
 #
 #   status          Boolean Determines if the player has the required information to play.
 #
+#   bytes_in        Integer Bytes received from the client.
+#
+#   bytes_out       Integer Bytes sent to the client.
+#
+#   messages_in     Integer Messages received from the client.
+#
+#   updates_out     Integer Frames built for the client.
+#
+#   udp_token       Integer The token the client's datagrams carry, 0 while it has no UDP channel.
+#
+#   udp_address     Tuple   Where the client's datagrams come from and frames are sent to, None until the first one arrives.
+#
+#   udp_sequence    Integer The sequence number of the newest datagram from the client, older ones are dropped.
+#
+#   heard_tick      Integer The tick the client last acked a snapshot, the UDP channel is closed if it goes quiet for UDP_TIMEOUT.
+#
+#   buckets         Dict    A TokenBucket for each rate limited message type, {...kind : <TokenBucket>,...}
+#
+#   merged_position Tuple   The newest position sent over the position limit, taken at the next snapshot. None if there is none.
+#
+#   positions_merged    Integer Positions over the limit, of which only the newest is taken at the next snapshot.
+#
+#   lasers_rejected     Integer Lasers over the limit that were never fired.
+#
+#   messages_dropped    Integer Any other messages over their limit, which are thrown away.
+#
 # Methods:      Parameters:     Description
-#   update_data     data (string)   Takes new data as supplied by the client and updates the properties of the player based on it.
-#                                   The data is in form (type char)(...data...) e.g "c255255255"
+#   update_data     kind (string)   Takes new data as supplied by the client and updates the properties of the player based on it.
+#                   fields (tuple)  e.g "c", (255, 255, 255)
+#
+#   set_field       kind (string)   Changes a property, giving it a new version if the value is different.
+#                   value
+#
+#   encode          kind (string)   Gives the message telling other clients about one of the player's fields, as kept in a
+#                   value           snapshot. A position of None is sent as out of view.
+#
+#   message         kind (string)   Gives the message for one of the player's fields as it is now, from messages.
+#
+#   full_message    shown (Boolean) Gives the messages for all of the player's fields, for a client they are new to.
 #
 #   reset_player    N/A             Resets the player's attributes but keeps them connected - so they can easily re-enter the game if they die.
+#                                   Other clients see the player as gone until they are ready again.
 #
-# LASER CLASS
+# LASER STORE
+# Holds every laser as rows of NumPy arrays rather than an object each, so moving, removing and encoding all of them
+# takes a handful of array operations per tick however many there are.
 # Attributes:   Type:       Description:
-#   position        Tuple       Holds two integers representing the position of a laser in the game
+#   count           Integer     The number of rows in use, live or dead.
 #
-#   data            String      The formatted string of information about the laser, laser_id, player_id, direction and current position
-
+#   ids             Array       Each row's laser id.
+#
+#   generations     Array       The low byte of the generation of each row's laser id.
+#
+#   owners          Array       The id of the player that fired each laser.
+#
+#   owner_generations   Array   The low byte of the generation of each owner's id when they fired.
+#
+#   colours         Array       Each laser's colour, (red, green, blue) rows.
+#
+#   positions       Array       Each laser's position, (x, y) rows.
+#
+#   velocities      Array       How far each laser moves per tick, (x, y) rows.
+#
+#   origins         Array       Where each laser was fired from, (x, y) rows.
+#
+#   directions      Array       The direction each laser was fired in, "w", "a", "s" or "d".
+#
+#   spawn_ticks     Array       The tick each laser was fired on, it is at its origin on that tick.
+#
+#   alive           Array       False for rows whose laser has been removed but not yet compacted away.
+#
+#   slots           Array       The row of each laser id, -1 when the id is not in use.
+#
+# Methods:      Parameters:     Description:
+#   add             laser_id, generation, owner, owner_generation, colour, direction, position, tick
+#                                   Adds a laser fired on a tick, growing the arrays if they are full.
+#
+#   remove          laser_id (Integer)  Marks a laser dead.
+#
+#   update          tick (Integer)  Moves every laser to where it is on a tick, removes those that left the map and compacts the rows.
+#                                   Returns the ids removed.
+#
+#   compact         N/A             Moves the live rows to the front.
+#
+#   encode          rows (Array)    Gives the lasers in rows encoded as laser spawns in one go, as LASER_FRAME records.
 #
 # SERVER CLASS
 # Attributes:   Type:       Description:
@@ -65,78 +177,558 @@
 #   server          Socket      Holds the socket object used by the server. Ip is taken from socket.getsockname() --> (ip, port)
 #
 #   players         Dict        Holds a dictionary where the keys are identities and values players.
-#                               e.g {..."01" : <Player Object>,...}
+#                               e.g {...1 : <Player Object>,...}
+#
+#   lasers          LaserStore  Holds every laser in the game.
+#
+#   player_ids      Registry    Hands out player ids (0 to MAX_PLAYERS - 1).
+#
+#   laser_ids       Registry    Hands out laser ids (0 to MAX_LASERS - 1).
+#
+#   connections     Dict        Maps each connection to its player's id, e.g {...<socket> : 1,...}
+#
+#   spatial         SpatialHash Indexes each tick's lasers for collision checks (see world.py).
+#
+#   collision_map   CollisionMap    The walls, for checking every laser against the map at once (see world.py).
+#
+#   tick            Integer     The number of the newest snapshot.
+#
+#   view_radius     Integer     How far from a player (along either axis) things are sent to them, 0 sends the whole map.
+#
+#   player_states   Dict        The newest snapshot of the players, mapping ("p", player_id) to the player's fields in
+#                               PLAYER_FIELDS order.
+#
+#   player_versions Array       The version of each player in player_states by id, -1 for ids not in it.
+#
+#   player_details  Array       The detail_version of each player in player_states by id, -1 for ids not in it.
+#
+#   player_positions    Array   The position of each player in player_states by id, (x, y) rows.
+#
+#   deltas          Dict        The player and laser part of this tick's frame for each acked snapshot, with the whole map
+#                               in view, {...acked snapshot : (data, count, spans),...} (see build_delta).
+#
+#   laser_positions Array       The newest snapshot of the lasers, the position of each live laser by row, (x, y) rows.
+#
+#   laser_order     Array       The rows of laser_positions in order of their laser's key.
+#
+#   laser_keys      Array       The key of each laser in the snapshot, sorted: its id plus the low byte of its generation
+#                               shifted up 16 bits, so a reused id is a different key.
+#
+#   laser_records   Array       The laser spawn of each laser in laser_keys (see LaserStore.encode).
+#
+#   profiler        TickProfiler    Times each phase of a tick (see metrics.py), None while metrics are switched off.
+#
+#   metrics_snapshot    Dict    The metrics as last published, for the metrics endpoint and the admin panel.
+#
+#   scheduler       TickScheduler   The scheduler running the ticks, for its overrun count.
+#
+#   recorder        Recorder        Records what clients send for replay.py (see recording.py), None while not recording.
+#
+#   udp             Boolean         Offers clients a UDP channel (see UDP CHANNEL in protocol.py).
+#
+#   udp_loss        Float           The share of datagrams thrown away in each direction, to test over loopback as if lossy.
+#
+#   datagrams       Socket          The UDP socket on the same port as the server, None without udp.
+#
+#   udp_tokens      Dict            The player id each UDP token belongs to.
+#
+#   rate_limits     Dict            The rate (a second) and burst of each message type a client can send, {...kind : (rate, burst),...}
+#                                   Types not listed are not limited.
 #
 # Methods:      Parameters:     Description:
 #   start_server    N/A             Creates the socket server object, changes server_state to reflect this.
 #
-#   process_data    data(string)    Takes the message containing player data sent to the server and updates properties, update.
-#                   client_id (Socket)
+#   process_data    kind (string)   Takes a decoded message sent to the server and updates properties, acks. Raises
+#                   fields (tuple)  ProtocolError for a laser fired in a direction other than w, a, s or d.
+#                   client (Socket)
 #
-#   server_clients  N/A             Runs the main server loop, takes inputs, outputs relevant data.
+#   serve_clients   N/A             Runs one tick of the main server loop, takes inputs, outputs relevant data.
 #
 #   remove_player   client_id (string)  Removes a client due to disconnection or being kicked.
 #
 #   stop_server     N/A             Shuts server down.
 #
-#   socket_to_id    Client (Socket) Gives the relevant player id of a socket connection.
+#   accept_client   N/A             Accepts a new connection waiting on the server socket, None if there is not one to add.
+#
+#   sock_to_id      Client (Socket) Gives the relevant player id of a socket connection.
+#
+#   add_player      Client (Socket) Adds a new player into the players list, returns their id (None when the server is full).
+#
+#   remove_laser    laser_id (Integer)  Removes a laser and frees its id.
+#
+#   read_client     player_id (Integer) Reads once (READ_SIZE) from a client's socket and processes what arrived, False
+#                                       once they have disconnected.
+#
+#   receive_data    player_id (Integer) Decodes and processes data already read from a client (the asyncio server, replays).
+#                   data (Bytes)
+#
+#   process_messages    player_id (Integer) Processes a client's decoded messages, within the client's rate limits.
+#                       messages (List)
+#
+#   admit           player (Player) Takes a token for a message from a client, returns False if it is over the limit. A
+#                   kind, fields    position over the limit is merged, the newest is kept for the next snapshot.
+#
+#   read_datagrams  N/A             Reads every datagram waiting, dropping any with an unknown token or out of order.
+#
+#   receive_datagram    player_id (Integer) Processes the messages in a datagram from a client, only positions and acks.
+#                       data (Bytes)
+#
+#   send_datagram   player_obj (Player) Sends a frame over a client's UDP channel.
+#                   data (Bytes)
+#
+#   close_channel   player_obj (Player) Goes back to TCP for everything with a client, telling them so.
+#
+#   update_world    N/A             Moves the lasers, frees the ids of those that have left the map and checks for collisions.
+#
+#   check_collisions    N/A         Removes lasers that hit walls (using collision_map) and hits players with lasers touching
+#                                   them (using spatial).
+#
+#   check_new_lasers    N/A         Checks the lasers fired this tick at their first position, as check_collisions does, before
+#                                   they are ever sent.
+#
+#   hit_player      player (Player) Takes a hit from the laser in a row of lasers, killing the player at 0 health.
+#                   row (Integer)
+#
+#   queue_event     player (Player) Queues an event (a hit or death) to be sent with the player's next update.
+#                   data (Bytes)
+#
+#   take_snapshot   N/A             Takes any merged positions, checks the lasers fired this tick, advances the tick and takes a
+#                                   snapshot of the world.
+#
+#   view_of         player_obj (Player) Gives the newest snapshot cut down to a client's area of interest, as a view:
+#                                       (player_versions, whether each player id is in view, laser keys), along with the
+#                                       indices of those lasers in laser_keys (None for all of them). Views share the
+#                                       snapshot's player_versions, and with the whole map in view its laser_keys too, so
+#                                       nothing of the world is copied per client.
+#
+#   build_update    player_obj (Player) Gives the frame taking a client from its acked snapshot to the newest one as a single buffer,
+#                                       so it can be sent with one write. Keeps the last SNAPSHOT_HISTORY views sent to them.
+#                                       With the whole map in view the delta is shared from deltas, only the client's own
+#                                       player is cut out of it.
+#
+#   build_delta     view, laser_indices Gives (data, count, spans), the messages taking a client from a baseline view to a
+#                   baseline            view, their number and where each player's messages are in data. The players with
+#                                       anything to send are found with array operations over every player id, then only
+#                                       their fields newer than the player's version in the baseline are sent. Laser keys
+#                                       are sorted, so the lasers gone and new are found with a binary search of one set of
+#                                       keys in the other.
+#
+#   enable_metrics  port (Integer)  Switches on the profiler, and serves the metrics on a local port if one is given.
+#
+#   publish_metrics N/A             Updates metrics_snapshot, once a second.
+#
+#   start_recording path (String)   Starts recording the match to a file.
+#
+#   stop_recording  N/A             Stops recording, waiting for the file to be written.
+#
+#   metrics         N/A             Gives the entity counts, overruns, profile and per client counters.
+#
+#   terminate       signum, frame   The SIGTERM handler, stops the server at the end of the tick.
+#
+#   run_headless    N/A             Runs the server without the admin panel, ticking at tick_rate until interrupted or
+#                                   sent SIGTERM.
+#
+# REGISTRY CLASS
+# Hands out ids from a free list, so allocating and releasing an id never has to search for a free one.
+# Each id has a generation which goes up every time it is released, so a reference made before the id was reused
+# (an id, generation pair) can be told apart from the entity that has the id now.
+# Methods:      Parameters:     Description:
+#   allocate        N/A             Gives a free id, or None when all of them are in use.
+#
+#   release         entity_id (Integer) Frees an id for reuse and moves it onto its next generation.
+#
+#   release_many    entity_ids (Array)  Frees a NumPy array of ids at once.
 #
-#   add_player      Client (Socket) Adds a new player into the players list.
+#   generation      entity_id (Integer) Gives the current generation of an id.
 #
-#   remove_dead     Removes dead Player objects
+#   is_current      entity_id (Integer) Checks that a reference to an id is for its current generation.
+#                   generation (Integer)
+#
+# TOKEN BUCKET
+# Limits how often a client can send one type of message. A bucket holds up to burst tokens and gains rate of them a second,
+# each message takes one. Time is counted in ticks, so a replay limits exactly what the recorded match did.
+# Methods:      Parameters:     Description:
+#   take            tick (Integer)  Takes a token, returns False if there are none.
+#
+# The tick only ever processes what one read (READ_SIZE) and a few datagrams (DATAGRAM_READS) from each client hold, so
+# however fast a client sends, its cost to a tick is bounded and the rest waits in the socket. The asyncio backend takes
+# one read a tick in the same way (see async_server.py).
+#
+# TICK SCHEDULER
+# Calls a tick function at a fixed rate, independent of how often run_pending is called (e.g. how fast the admin panel redraws).
+# Each tick has an absolute deadline one interval after the last, so time lost to sleeping or slow ticks does not drift the rate.
+# Attributes:   Type:       Description:
+#   interval        Float       Seconds between ticks (1 / tick_rate).
+#
+#   max_catchup     Integer     The most ticks run back to back when behind, past this the missed ticks are dropped.
+#
+#   overruns        Integer     How many times the scheduler fell too far behind and dropped ticks.
+#
+# Methods:      Parameters:     Description:
+#   run_pending     N/A             Runs every tick that is due, returns how many were run.
+#
+#   run_forever     running (function)  Runs ticks on schedule, sleeping in between, until running() is False.
+#
+# RUNNING
+#   python server.py --host 0.0.0.0 --port 6000 --tick-rate 60              Runs the server with the admin panel.
+#   python server.py --headless --host 0.0.0.0 --port 6000 --tick-rate 60   Runs the server without a display.
+#   python server.py --headless --backend asyncio --queue-size 8 --slow-clients drop
+#                                                                           Runs the headless server on asyncio (see async_server.py).
+#   python server.py --headless --view-radius 200                           Only sends clients what is within 200 of them.
+#   python lobby.py --host 0.0.0.0 --port 6000 --arena-size 16              Runs many matches at once, one process each (see lobby.py).
+#   python server.py --headless --rate-limit l=4/4 --rate-limit p=120/20   Lets a client fire 4 lasers a second (bursts of 4) and
+#                                                                           send 120 positions a second (bursts of 20).
+#   python server.py --headless --udp                                       Offers clients the UDP channel, add --udp-loss 0.2 to
+#                                                                           drop a fifth of the datagrams, as if on a lossy network.
+#   python server.py --headless --record match.rec                          Records the match, python replay.py match.rec plays it back.
+#   python server.py --headless --metrics-port 9100                         Serves the tick profile and counters on
+#                                                                           http://127.0.0.1:9100/metrics (see metrics.py).
+# F3 in the admin panel shows the tick profile over the player list, switching the profiler on if it is not already.
 
+import argparse
+import itertools
+import random
+import secrets
+import signal
 import socket
+from collections import deque
+
+import numpy
 import select
-import pygame
+import time
 import _thread as thread
 
+from world import LASER_SIZE, LASER_VELOCITIES, PLAYER_SIZE, WORLD_SIZE, CollisionMap, SpatialHash, box
+from metrics import MetricsEndpoint, TickProfiler
+from recording import Recorder, state_checksum, STATE
+from protocol import CLIENT_MESSAGES, SERVER_MESSAGES, DATAGRAM_HEADER, HEADER, MAX_DATAGRAM, NO_PLAYER, PROTOCOL_VERSION, PLAYER_FIELDS, READ_SIZE, SNAPSHOT_HISTORY, FrameDecoder, ProtocolError
+
+try:
+    import pygame
+    from textcache import TextCache
+except ImportError:
+    # The admin panel is optional, a headless server does not need pygame.
+    pygame = None
+
 class Player:
     def __init__(self, identity, connection):
-        self.properties = {"c": False, "n": False, "p": False, "h": 0, "k": 0}
+        self.properties = {"c": None, "n": None, "p": None, "h": None, "k": 0}
+        self.version = next(VERSIONS)
+        self.versions = dict.fromkeys(PLAYER_FIELDS, self.version)
+        self.detail_version = self.version
+        self.messages = dict()
+        self.full_messages = dict()
+        self.out_of_view = SERVER_MESSAGES.encode("q", identity)
         self.colour_formatted = False
         self.identity = identity
         self.connection = connection
-        self.update = dict()
+        self.decoder = FrameDecoder(CLIENT_MESSAGES)
+        self.outbox = bytearray()
+        self.events = bytearray()
+        self.acked = 0
+        self.views = dict()
+        self.view_position = None
         self.status = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.updates_out = 0
+        self.udp_token = 0
+        self.udp_address = None
+        self.udp_sequence = 0
+        self.heard_tick = 0
+        self.buckets = dict()
+        self.merged_position = None
+        self.positions_merged = 0
+        self.lasers_rejected = 0
+        self.messages_dropped = 0
+
+    def set_field(self, kind, value):
+        if self.properties[kind] != value:
+            self.properties[kind] = value
+            self.version = self.versions[kind] = next(VERSIONS)
+            if kind != "p":
+                self.detail_version = self.version
+            self.messages.pop(kind, None)
+            self.full_messages.clear()
+
+    def update_data(self, kind, fields):
+        if kind in ("c", "p"):
+            self.set_field(kind, tuple(fields))
+        else:
+            self.set_field(kind, fields[0])
+        if kind == "c":
+            self.colour_formatted = fields
+        self.status = all([self.properties[index] is not None for index in self.properties if index != "k"])
 
-    def update_data(self, data):
-        self.properties[data[0]] = data[1:]
-        if data[0] == "c":
-            self.colour_formatted = (int(data[1:4]), int(data[4:7]), int(data[7:10]))
-        self.status = all([self.properties[index] for index in self.properties if index != "k"])
+    def encode(self, kind, value):
+        if value is None:
+            return SERVER_MESSAGES.encode("q", self.identity)
+        if kind in ("c", "p"):
+            return SERVER_MESSAGES.encode(kind, self.identity, *value)
+        return SERVER_MESSAGES.encode(kind, self.identity, value)
+
+    def message(self, kind):
+        message = self.messages.get(kind)
+        if message is None:
+            message = self.messages[kind] = self.encode(kind, self.properties[kind])
+        return message
+
+    def full_message(self, shown):
+        data = self.full_messages.get(shown)
+        if data is None:
+            data = self.full_messages[shown] = b"".join([self.message(kind) if kind != "p" or shown else self.out_of_view for kind in PLAYER_FIELDS])
+        return data
 
     def reset_player(self):
-        self.properties = {"c": False, "n": False, "p": False, "h": False, "k": 0}
-        self.colour_formatted = False
+        # The name and colour are kept, as the client only sends its health and position again when it respawns.
+        self.set_field("p", None)
+        self.set_field("h", None)
+        self.set_field("k", 0)
         self.status = False
 
-class Laser:
-    def __init__(self, data, id, colour, player_id):
-        self.data = str()
-        self.colour = colour
-        self.position = [int(data[1:5]), int(data[5:9])]
-        self.laser_id = id
-        self.player_id = player_id
-        self.direction = data[0]
-        self.update_laser()
-
-    def update_laser(self):
-        laser_speed = 5
-        if self.direction == "w":
-            self.position[1] -= laser_speed
-        elif self.direction == "s":
-            self.position[1] += laser_speed
-        elif self.direction == "a":
-            self.position[0] -= laser_speed
-        elif self.direction == "d":
-            self.position[0] += laser_speed
-        self.data = self.laser_id + self.player_id + self.colour + str(self.position[0]).zfill(4) + str(self.position[1]).zfill(4)
-
-class Server(Player, Laser):
-    def __init__(self, hostname):
+# Laser spawn frames built straight from the arrays, the layout must match the "v" format in protocol.py.
+LASER_FRAME = numpy.dtype([("kind", "u1"), ("size", ">u2"), ("id", ">u2"), ("generation", "u1"), ("owner", "u1"), ("colour", "u1", (3,)), ("origin", ">i2", (2,)),
+                           ("direction", "S1"), ("tick", ">u4")])
+
+class LaserStore:
+    def __init__(self, capacity, size=64):
+        self.count = 0
+        self.ids = numpy.zeros(size, numpy.int32)
+        self.generations = numpy.zeros(size, numpy.uint8)
+        self.owners = numpy.zeros(size, numpy.uint8)
+        self.owner_generations = numpy.zeros(size, numpy.uint8)
+        self.colours = numpy.zeros((size, 3), numpy.uint8)
+        self.positions = numpy.zeros((size, 2), numpy.int32)
+        self.velocities = numpy.zeros((size, 2), numpy.int32)
+        self.origins = numpy.zeros((size, 2), numpy.int32)
+        self.directions = numpy.zeros(size, "S1")
+        self.spawn_ticks = numpy.zeros(size, numpy.uint32)
+        self.alive = numpy.zeros(size, bool)
+        # Which row each laser id is in, -1 for ids not in use.
+        self.slots = numpy.full(capacity, -1, numpy.int32)
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.alive[:self.count]))
+
+    def __contains__(self, laser_id):
+        return 0 <= laser_id < len(self.slots) and self.slots[laser_id] >= 0
+
+    def add(self, laser_id, generation, owner, owner_generation, colour, direction, position, tick):
+        if self.count == len(self.ids):
+            self.compact()
+            if self.count == len(self.ids):
+                self.grow()
+        row = self.count
+        self.count += 1
+        self.ids[row] = laser_id
+        self.generations[row] = generation % 256
+        self.owners[row] = owner
+        self.owner_generations[row] = owner_generation % 256
+        self.colours[row] = colour
+        self.velocities[row] = LASER_VELOCITIES[direction]
+        self.origins[row] = position
+        self.directions[row] = direction
+        self.spawn_ticks[row] = tick
+        # Placed where they will be in the next snapshot, one step from their origin.
+        self.positions[row] = position
+        self.positions[row] += self.velocities[row]
+        self.alive[row] = True
+        self.slots[laser_id] = row
+
+    def remove(self, laser_id):
+        # The row is left dead until the next compaction.
+        self.alive[self.slots[laser_id]] = False
+        self.slots[laser_id] = -1
+
+    def update(self, tick):
+        # Moves every laser to where it is on a tick, kills those that have left the map and compacts, returning the ids that left.
+        # Positions come from the origin and spawn tick, the same as on the client, so the two never drift apart.
+        count = self.count
+        positions = self.positions[:count]
+        positions[:] = self.origins[:count] + self.velocities[:count] * (tick - self.spawn_ticks[:count].astype(numpy.int64))[:, None]
+        inside = ((positions >= 0) & (positions < WORLD_SIZE)).all(axis=1)
+        left = self.alive[:count] & ~inside
+        left_ids = self.ids[:count][left]
+        self.slots[left_ids] = -1
+        self.alive[:count] &= inside
+        self.compact()
+        return left_ids
+
+    def compact(self):
+        keep = numpy.flatnonzero(self.alive[:self.count])
+        count = len(keep)
+        for array in (self.ids, self.generations, self.owners, self.owner_generations, self.colours, self.positions, self.velocities, self.origins,
+                      self.directions, self.spawn_ticks):
+            array[:count] = array[keep]
+        self.alive[:count] = True
+        self.alive[count:self.count] = False
+        self.count = count
+        self.slots[self.ids[:count]] = numpy.arange(count, dtype=numpy.int32)
+
+    def grow(self):
+        size = len(self.ids) * 2
+        for name in ("ids", "generations", "owners", "owner_generations", "colours", "positions", "velocities", "origins", "directions", "spawn_ticks", "alive"):
+            old = getattr(self, name)
+            new = numpy.zeros((size,) + old.shape[1:], old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def encode(self, rows):
+        # Gives the lasers in rows encoded as laser spawns, as LASER_FRAME records.
+        records = numpy.zeros(len(rows), LASER_FRAME)
+        records["kind"] = ord("v")
+        records["size"] = LASER_FRAME.itemsize - HEADER.size
+        records["id"] = self.ids[rows]
+        records["generation"] = self.generations[rows]
+        records["owner"] = self.owners[rows]
+        records["colour"] = self.colours[rows]
+        records["origin"] = self.origins[rows]
+        records["direction"] = self.directions[rows]
+        records["tick"] = self.spawn_ticks[rows]
+        return records
+
+MAX_PLAYERS = 99
+MAX_LASERS = 65535
+
+# Enough to cover the 200 x 200 view of the client wherever the camera is.
+VIEW_RADIUS = 200
+# The health every player respawns with.
+MAX_HEALTH = 10
+POSITION_FIELD = PLAYER_FIELDS.index("p")
+# Hands out the versions of every player's fields.
+VERSIONS = itertools.count(1)
+
+# Seconds a client's UDP channel can go without an ack before the server goes back to TCP for them.
+UDP_TIMEOUT = 2
+
+# The most datagrams read a tick for each player.
+DATAGRAM_READS = 4
+
+# A client sends a position and an ack at most once a frame, and fires every 25 steps of 60 a second.
+RATE_LIMITS = {"p": (120, 20), "a": (120, 20), "l": (4, 4), "n": (2, 4), "c": (2, 4), "h": (2, 4), "i": (1, 2)}
+
+class Registry:
+    def __init__(self, capacity):
+        # Released ids go to the back of the free list, so an id is reused as late as possible.
+        self.free = deque(range(0, capacity))
+        self.generations = numpy.zeros(capacity, numpy.uint32)
+
+    def allocate(self):
+        if not self.free:
+            return None
+        return self.free.popleft()
+
+    def release(self, entity_id):
+        self.generations[entity_id] += 1
+        self.free.append(entity_id)
+
+    def release_many(self, entity_ids):
+        self.generations[entity_ids] += 1
+        self.free.extend(entity_ids.tolist())
+
+    def generation(self, entity_id):
+        return int(self.generations[entity_id])
+
+    def is_current(self, entity_id, generation):
+        # Generations on the wire are one byte, so only the low byte is compared.
+        return 0 <= entity_id < len(self.generations) and int(self.generations[entity_id]) % 256 == generation % 256
+
+class TokenBucket:
+    def __init__(self, rate, burst, tick_rate, tick=0):
+        self.per_tick = rate / tick_rate
+        self.burst = burst
+        self.tokens = burst
+        self.tick = tick
+
+    def take(self, tick):
+        if tick != self.tick:
+            self.tokens = min(self.burst, self.tokens + (tick - self.tick) * self.per_tick)
+            self.tick = tick
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class TickScheduler:
+    def __init__(self, tick, tick_rate, max_catchup=5):
+        self.tick = tick
+        self.interval = 1 / tick_rate
+        self.max_catchup = max_catchup
+        self.next_tick = None
+        self.ticks = 0
+        self.overruns = 0
+
+    def run_pending(self):
+        now = time.perf_counter()
+        if self.next_tick is None:
+            self.next_tick = now
+        ran = 0
+        while now >= self.next_tick and ran < self.max_catchup:
+            self.tick()
+            self.ticks += 1
+            ran += 1
+            self.next_tick += self.interval
+            now = time.perf_counter()
+        if now - self.next_tick > self.interval * self.max_catchup:
+            # Too far behind to ever catch up, so skip the missed ticks instead of running them all at once.
+            self.overruns += 1
+            self.next_tick = now + self.interval
+        return ran
+
+    def run_forever(self, running):
+        while running():
+            self.run_pending()
+            delay = self.next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+def sorted_contains(keys, values):
+    # Which of values are in keys, both sorted arrays.
+    if not len(keys):
+        return numpy.zeros(len(values), bool)
+    index = numpy.minimum(numpy.searchsorted(keys, values), len(keys) - 1)
+    return keys[index] == values
+
+# The players in view of a client with the whole map in view, and of one with nowhere in view, by id.
+ALL_IN_VIEW = numpy.ones(MAX_PLAYERS, bool)
+NONE_IN_VIEW = numpy.zeros(MAX_PLAYERS, bool)
+# The player versions of a snapshot without any players.
+NO_PLAYERS = numpy.full(MAX_PLAYERS, -1, numpy.int64)
+
+class Server(Player):
+    def __init__(self, hostname, port=6000, tick_rate=60, view_radius=VIEW_RADIUS, udp=False, udp_loss=0, rate_limits=None):
         self.hostname = hostname
+        self.port = port
+        self.tick_rate = tick_rate
+        self.view_radius = view_radius
+        self.udp = udp
+        self.udp_loss = udp_loss
+        self.datagrams = None
+        self.udp_tokens = dict()
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
         self.players = dict()
-        self.lasers = dict()
+        self.lasers = LaserStore(MAX_LASERS)
+        self.player_ids = Registry(MAX_PLAYERS)
+        self.spatial = SpatialHash()
+        self.collision_map = CollisionMap()
+        self.laser_ids = Registry(MAX_LASERS)
+        self.connections = dict()
+        self.tick = 0
+        self.player_states = dict()
+        self.player_versions = NO_PLAYERS
+        self.player_details = NO_PLAYERS
+        self.player_positions = numpy.zeros((MAX_PLAYERS, 2), numpy.int64)
+        self.deltas = dict()
+        self.laser_positions = numpy.zeros((0, 2), numpy.int32)
+        self.laser_order = numpy.zeros(0, numpy.intp)
+        self.laser_keys = numpy.zeros(0, numpy.int64)
+        self.laser_records = numpy.zeros(0, LASER_FRAME)
+        self.profiler = None
+        self.metrics_snapshot = dict()
+        self.scheduler = None
+        self.recorder = None
         self.server_state = "OFFLINE"
 
     def start_server(self):
@@ -144,132 +736,527 @@ class Server(Player, Laser):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setblocking(False)
         # self.server.bind((socket.gethostbyname(socket.gethostname()), 6000))
-        self.server.bind((self.hostname, 6000))
+        self.server.bind((self.hostname, self.port))
+        if self.udp:
+            self.datagrams = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagrams.setblocking(False)
+            self.datagrams.bind((self.hostname, self.port))
         self.server_state = "CONNECTED"
         self.server.listen(10)
 
-    def process_data(self, data, client):
+    def process_data(self, kind, fields, client):
         player_id = self.sock_to_id(client)
-        if data[0] == "l":
-            if self.players[player_id].status:
-                self.lasers[str([index for index in range(0, 999) if str(index).zfill(3) not in self.lasers][0]).zfill(3)] = Laser(data[1:], str([index for index in range(0, 999) if str(index).zfill(3) not in self.lasers][0]).zfill(3), self.players[player_id].properties["c"], player_id)
-        elif data[0] == "o":
-            try:
-                del self.lasers[data[1:]]
-            except KeyError:
-                pass
-        if data[0] == "k":
-            self.players[player_id].reset_player()
-            self.players[data[1:]].properties["k"] = str(int(self.players[data[1:]].properties["k"]) + 1)
-            for player in self.players.values():
-                if data[1:] in player.update:
-                    player.update[data[1:]].append("k")
-                else:
-                    player.update[data[1:]] = ["k"]
-        else:
-            self.players[player_id].update_data(data)
-            for player in self.players.values():
-                if player != self.players[player_id]:
-                    if player_id in player.update:
-                        player.update[player_id].append(data[0])
-                    else:
-                        player.update[player_id] = [data[0]]
+        if kind == "i":
+            if fields[0] != PROTOCOL_VERSION:
+                self.remove_player(player_id)
+        elif kind == "l":
+            if fields[0] not in LASER_VELOCITIES:
+                raise ProtocolError("bad laser direction " + repr(fields[0]))
+            player = self.players[player_id]
+            if player.status:
+                laser_id = self.laser_ids.allocate()
+                if laser_id is not None:
+                    # Fired from where the server has the player, not where the message says.
+                    self.lasers.add(laser_id, self.laser_ids.generation(laser_id), player_id, self.player_ids.generation(player_id), player.properties["c"], fields[0], player.properties["p"], self.tick)
+        elif kind == "a":
+            self.players[player_id].acked = fields[0]
+            self.players[player_id].heard_tick = self.tick
+        elif kind == "h":
+            # Health is the server's to decide, a client only says it is respawning, which it can only do while dead.
+            if not self.players[player_id].status:
+                self.players[player_id].update_data(kind, (MAX_HEALTH,))
+        elif kind in ("c", "n", "p"):
+            self.players[player_id].update_data(kind, fields)
+            if kind == "p":
+                self.players[player_id].view_position = fields
+
+    def accept_client(self):
+        connection, ip = self.server.accept()
+        return connection
 
     def sock_to_id(self, client):
-        for player in self.players:
-            if self.players[player].connection is client:
-                return player
+        return self.connections.get(client)
 
     def add_player(self, client):
-        client_id = [str(pot_id).zfill(2) for pot_id in range(0, 99) if not str(pot_id).zfill(2) in self.players][0]
+        client_id = self.player_ids.allocate()
+        if client_id is None:
+            return None
         self.players[client_id] = Player(client_id, client)
-        for player in self.players.values():
-            if player != self.players[client_id]:
-                player.update[client_id] = ["c", "n", "p", "h"]
-                self.players[client_id].update[player.identity] = ["c", "n", "p", "h"]
-
-    def remove_dead(self):
-        try:
-            for player_id in self.players:
-                try:
-                    self.players[player_id].connection.sendall("+u".encode())
-                except socket.error:
-                    self.remove_player(player_id)
-        except RuntimeError:
-            pass
+        for kind, (rate, burst) in self.rate_limits.items():
+            self.players[client_id].buckets[kind] = TokenBucket(rate, burst, self.tick_rate, self.tick)
+        self.connections[client] = client_id
+        self.players[client_id].outbox += SERVER_MESSAGES.encode("i", PROTOCOL_VERSION, client_id)
+        if self.datagrams is not None:
+            token = 0
+            while not token or token in self.udp_tokens:
+                token = secrets.randbits(32)
+            self.players[client_id].udp_token = token
+            self.players[client_id].heard_tick = self.tick
+            self.udp_tokens[token] = client_id
+            self.players[client_id].outbox += SERVER_MESSAGES.encode("y", token, self.port)
+        if self.recorder:
+            self.recorder.record(self.tick, b"j", client_id)
+        return client_id
 
     def remove_player(self, client_id):
         try:
-            self.players[client_id].connection.sendall("+x".encode())
+            # Anything still waiting goes first so the closing message is not cut into the middle of a frame.
+            self.players[client_id].outbox += SERVER_MESSAGES.encode("x")
+            self.players[client_id].connection.send(self.players[client_id].outbox)
             self.players[client_id].connection.close()
         except socket.error:
             pass
-        for client in self.players.values():
-            client.update[client_id] = ["z"]
+        del self.connections[self.players[client_id].connection]
+        self.udp_tokens.pop(self.players[client_id].udp_token, None)
         del self.players[client_id]
+        self.player_ids.release(client_id)
+        if self.recorder:
+            self.recorder.record(self.tick, b"x", client_id)
+
+    def remove_laser(self, laser_id):
+        self.lasers.remove(laser_id)
+        self.laser_ids.release(laser_id)
 
     def stop_server(self):
         try:
             [self.remove_player(player_id) for player_id in self.players]
             self.server.close()
+            if self.datagrams is not None:
+                self.datagrams.close()
+                self.datagrams = None
             self.server_state = "OFFLINE"
         except RuntimeError:
             self.stop_server()
+        self.stop_recording()
+
+    def read_client(self, player_id):
+        data = self.players[player_id].connection.recv(READ_SIZE)
+        if not data:
+            return False
+        self.receive_data(player_id, data)
+        return True
+
+    def receive_data(self, player_id, data):
+        if self.recorder:
+            self.recorder.record(self.tick, b"d", player_id, data)
+        player = self.players[player_id]
+        player.bytes_in += len(data)
+        self.process_messages(player_id, player.decoder.feed(data))
+
+    def process_messages(self, player_id, messages):
+        player = self.players[player_id]
+        player.messages_in += len(messages)
+        for kind, fields in messages:
+            if kind == "x":
+                self.remove_player(player_id)
+            elif self.admit(player, kind, fields):
+                self.process_data(kind, fields, player.connection)
+            if player_id not in self.players:
+                break
+
+    def read_datagrams(self):
+        # Anything past DATAGRAM_READS a player is left for the next tick, or dropped by the system if it keeps coming.
+        for index in range(0, DATAGRAM_READS * max(len(self.players), 1)):
+            try:
+                data, address = self.datagrams.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            except ConnectionError:
+                # Some systems report an earlier datagram being refused on the next read.
+                continue
+            if len(data) < DATAGRAM_HEADER.size or (self.udp_loss and random.random() < self.udp_loss):
+                continue
+            token, sequence = DATAGRAM_HEADER.unpack_from(data)
+            player_id = self.udp_tokens.get(token)
+            if player_id is None:
+                continue
+            player = self.players[player_id]
+            if sequence <= player.udp_sequence:
+                # Older than one already taken, so anything in it has been superseded.
+                continue
+            player.udp_sequence = sequence
+            player.udp_address = address
+            try:
+                self.receive_datagram(player_id, memoryview(data)[DATAGRAM_HEADER.size:])
+            except ProtocolError:
+                # A damaged datagram is dropped like a lost one.
+                pass
+
+    def receive_datagram(self, player_id, data):
+        messages = CLIENT_MESSAGES.decode_all(data)
+        if self.recorder:
+            self.recorder.record(self.tick, b"u", player_id, data)
+        player = self.players[player_id]
+        player.bytes_in += len(data)
+        player.messages_in += len(messages)
+        for kind, fields in messages:
+            # Only what the next datagram would supersede is taken over UDP.
+            if kind in ("p", "a") and self.admit(player, kind, fields):
+                self.process_data(kind, fields, player.connection)
 
-    def check_lasers(self):
+    def admit(self, player, kind, fields):
+        bucket = player.buckets.get(kind)
+        if bucket is None or bucket.take(self.tick):
+            if kind == "p":
+                # Anything merged before this is older.
+                player.merged_position = None
+            return True
+        if kind == "p":
+            player.positions_merged += 1
+            player.merged_position = fields
+        elif kind == "l":
+            player.lasers_rejected += 1
+        else:
+            player.messages_dropped += 1
+        return False
+
+    def send_datagram(self, player_obj, data):
+        if self.udp_loss and random.random() < self.udp_loss:
+            return
         try:
-            for laser_id in self.lasers:
-                if not 0 <= self.lasers[laser_id].position[0] <= 999 or not 0 <= self.lasers[laser_id].position[1] <= 999:
-                    del self.lasers[laser_id]
-        except RuntimeError:
+            self.datagrams.sendto(data, player_obj.udp_address)
+            player_obj.bytes_out += len(data)
+        except OSError:
+            # A full send buffer or an unreachable client, either way the frame is lost and the next one covers it.
             pass
 
+    def close_channel(self, player_obj):
+        self.udp_tokens.pop(player_obj.udp_token, None)
+        player_obj.udp_token = 0
+        player_obj.udp_address = None
+        player_obj.outbox += SERVER_MESSAGES.encode("y", 0, 0)
+
+    def update_world(self):
+        # The world is updated for the tick of the next snapshot.
+        if self.recorder:
+            self.recorder.record(self.tick, b"w")
+        self.laser_ids.release_many(self.lasers.update(self.tick + 1))
+        if self.profiler:
+            self.profiler.mark("lasers")
+        self.check_collisions()
+        if self.profiler:
+            self.profiler.mark("collisions")
+
+    def check_collisions(self):
+        lasers = self.lasers
+        positions = lasers.positions[:lasers.count]
+        for row in numpy.flatnonzero(self.collision_map.blocked_many(positions, LASER_SIZE) & lasers.alive[:lasers.count]):
+            self.remove_laser(int(lasers.ids[row]))
+        # Each player is only checked against the lasers in the cells around them.
+        self.spatial.index_points(positions)
+        for player in list(self.players.values()):
+            if not player.status:
+                continue
+            rows = self.spatial.query_points(box(player.properties["p"], PLAYER_SIZE + LASER_SIZE))
+            if not len(rows):
+                continue
+            touching = (numpy.abs(positions[rows] - player.properties["p"]) < (PLAYER_SIZE + LASER_SIZE) / 2).all(axis=1)
+            for row in rows[touching & lasers.alive[rows] & (lasers.owners[rows] != player.identity)]:
+                self.hit_player(player, row)
+                if not player.status:
+                    break
+
+    def check_new_lasers(self):
+        # Lasers are added one step from their origin and update_world only checks them after their next step, so the first
+        # step is checked here. Without it a target next to the muzzle is missed, and a laser fired into a wall is drawn.
+        lasers = self.lasers
+        rows = numpy.flatnonzero(lasers.alive[:lasers.count] & (lasers.spawn_ticks[:lasers.count] == self.tick))
+        if not len(rows):
+            return
+        for row in rows[self.collision_map.blocked_many(lasers.positions[rows], LASER_SIZE)]:
+            self.remove_laser(int(lasers.ids[row]))
+        players = [player for player in self.players.values() if player.status]
+        if not players:
+            return
+        # A tick's new lasers are few, so every player is checked against all of them at once.
+        centres = numpy.array([player.properties["p"] for player in players])
+        touching = (numpy.abs(lasers.positions[rows][None, :, :] - centres[:, None, :]) < (PLAYER_SIZE + LASER_SIZE) / 2).all(axis=2)
+        for index in numpy.flatnonzero(touching.any(axis=1)):
+            player = players[index]
+            for row in rows[touching[index]]:
+                if lasers.alive[row] and lasers.owners[row] != player.identity:
+                    self.hit_player(player, row)
+                    if not player.status:
+                        break
+
+    def hit_player(self, player, row):
+        shooter_id = int(self.lasers.owners[row])
+        shooter_generation = int(self.lasers.owner_generations[row])
+        self.remove_laser(int(self.lasers.ids[row]))
+        player.set_field("h", player.properties["h"] - 1)
+        self.queue_event(player, SERVER_MESSAGES.encode("t", player.identity, shooter_id, player.properties["h"]))
+        if player.properties["h"] <= 0:
+            # The shooter may have left since firing, and their id been given to someone else.
+            killer_id = NO_PLAYER
+            if shooter_id in self.players and self.player_ids.is_current(shooter_id, shooter_generation):
+                killer_id = shooter_id
+                killer = self.players[killer_id]
+                killer.set_field("k", killer.properties["k"] + 1)
+            player.reset_player()
+            death = SERVER_MESSAGES.encode("d", player.identity, killer_id)
+            for other in self.players.values():
+                self.queue_event(other, death)
+
+    def queue_event(self, player, data):
+        player.events += data
+
     def serve_clients(self):
-        self.check_lasers()
-        [laser.update_laser() for laser in self.lasers.values()]
-        inputs, outputs, exceptions = select.select([player.connection for player in self.players.values()] + [self.server], [player.connection for player in self.players.values()], [])
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+        self.update_world()
+        listening = [self.server]
+        if self.datagrams is not None:
+            listening.append(self.datagrams)
+        inputs, outputs, exceptions = select.select([player.connection for player in self.players.values()] + listening, [player.connection for player in self.players.values()], [], 0)
+        if profiler:
+            profiler.mark("select")
         for event in inputs:
             if event is self.server:
-                connection, ip = self.server.accept()
-                self.add_player(connection)
+                connection = self.accept_client()
+                if connection is None:
+                    continue
+                connection.setblocking(False)
+                # Each tick's update is one send, which should go out straight away rather than wait on the last one's ack.
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self.add_player(connection) is None:
+                    # The server is full.
+                    connection.close()
+            elif event is self.datagrams:
+                self.read_datagrams()
             else:
                 try:
-                    data = event.recv(1024).decode()
-                    for item in data.split("+"):
-                        item = item.strip()
-                        if item == "":
-                            pass
-                        elif item == "x":
-                            self.remove_player(self.sock_to_id(event))
-                        else:
-                            self.process_data(item, event)
+                    if not self.read_client(self.sock_to_id(event)):
+                        self.remove_player(self.sock_to_id(event))
+                except ProtocolError:
+                    self.remove_player(self.sock_to_id(event))
                 except socket.error:
-                    self.remove_dead()
+                    self.remove_player(self.sock_to_id(event))
+        if profiler:
+            profiler.mark("input")
 
+        self.take_snapshot()
+        if profiler:
+            profiler.mark("snapshot")
+        # Clients whose socket has failed are removed once every update is built, as they are still in the snapshot.
+        failed = list()
         for event in outputs:
+            player_id = self.sock_to_id(event)
+            if player_id is None:
+                continue
+            player_obj = self.players[player_id]
+            if player_obj.udp_token and self.tick - player_obj.heard_tick > UDP_TIMEOUT * self.tick_rate:
+                # Frames are not getting through, or acks are not coming back (UDP may be blocked altogether).
+                self.close_channel(player_obj)
+            if player_obj.udp_address is not None:
+                # Over UDP a frame goes every tick however far behind TCP is, only one too big for a datagram waits for it.
+                update = self.build_update(player_obj)
+                player_obj.updates_out += 1
+                if len(update) <= MAX_DATAGRAM:
+                    self.send_datagram(player_obj, update)
+                elif not player_obj.outbox:
+                    player_obj.outbox += update
+                player_obj.outbox += player_obj.events
+            # A client still working through the last update is skipped this tick rather than queueing more behind it.
+            # Events are never skipped, they are only sent once.
+            elif not player_obj.outbox:
+                player_obj.outbox += player_obj.events
+                player_obj.outbox += self.build_update(player_obj)
+                player_obj.updates_out += 1
+            else:
+                player_obj.outbox += player_obj.events
+            player_obj.events.clear()
             try:
-                event.sendall("+u".encode())
-                for laser in self.lasers.values():
-                    event.sendall(("+v" + laser.data).encode())
-                player_obj = self.players[self.sock_to_id(event)]
-                for player_id in player_obj.update:
-                    try:
-                        for request in player_obj.update[player_id]:
-                            if request == "z":
-                                event.sendall(("+" + player_id + "z").encode())
-                            if self.players[player_id].properties[request]:
-                                event.sendall(("+" + player_id + request + self.players[player_id].properties[request]).encode())
-                                del player_obj.update[player_id][player_obj.update[player_id].index(request)]
-                    except KeyError:
-                        self.remove_dead()
+                sent = event.send(player_obj.outbox)
+                del player_obj.outbox[:sent]
+                player_obj.bytes_out += sent
+            except BlockingIOError:
+                pass
             except socket.error:
-                self.remove_dead()
+                failed.append(player_id)
+        for player_id in failed:
+            self.remove_player(player_id)
+        if profiler:
+            profiler.mark("output")
+            profiler.finish()
+            self.publish_metrics()
+
+    def enable_metrics(self, port=None):
+        self.profiler = TickProfiler(1 / self.tick_rate)
+        if port:
+            MetricsEndpoint(self, "127.0.0.1", port).start()
+
+    def start_recording(self, path):
+        self.recorder = Recorder(path, self.tick_rate, self.view_radius, self.rate_limits)
+
+    def stop_recording(self):
+        if self.recorder:
+            recorder = self.recorder
+            self.recorder = None
+            recorder.close()
+
+    def publish_metrics(self):
+        if self.tick % self.tick_rate == 0:
+            self.metrics_snapshot = self.metrics()
+
+    def metrics(self):
+        clients = dict()
+        for player in self.players.values():
+            clients[player.identity] = {"bytes_in": player.bytes_in, "bytes_out": player.bytes_out, "messages_in": player.messages_in,
+                                        "updates_out": player.updates_out, "outbox": len(player.outbox), "positions_merged": player.positions_merged,
+                                        "lasers_rejected": player.lasers_rejected, "messages_dropped": player.messages_dropped}
+        return {"tick": self.tick, "players": len(self.players), "lasers": len(self.lasers), "overruns": self.scheduler.overruns if self.scheduler else 0,
+                "profile": self.profiler.summary() if self.profiler else None, "clients": clients}
+
+    def take_snapshot(self):
+        for player in list(self.players.values()):
+            if player.merged_position is not None:
+                self.process_data("p", player.merged_position, player.connection)
+                player.merged_position = None
+        self.check_new_lasers()
+        self.tick += 1
+        self.player_states = dict()
+        self.player_versions = numpy.full(MAX_PLAYERS, -1, numpy.int64)
+        self.player_details = numpy.full(MAX_PLAYERS, -1, numpy.int64)
+        self.player_positions = numpy.zeros((MAX_PLAYERS, 2), numpy.int64)
+        for player in self.players.values():
+            if player.status:
+                self.player_states[("p", player.identity)] = tuple([player.properties[kind] for kind in PLAYER_FIELDS])
+                self.player_versions[player.identity] = player.version
+                self.player_details[player.identity] = player.detail_version
+                self.player_positions[player.identity] = player.properties["p"]
+        self.deltas = dict()
+        lasers = self.lasers
+        live = numpy.flatnonzero(lasers.alive[:lasers.count])
+        self.laser_positions = lasers.positions[live]
+        keys = lasers.ids[live].astype(numpy.int64) | lasers.generations[live].astype(numpy.int64) << 16
+        self.laser_order = numpy.argsort(keys, kind="stable")
+        keys = keys[self.laser_order]
+        # A laser never changes once fired, so with none fired or gone the last tick's keys and spawns still hold, and
+        # keeping the same array lets a client whose view has not changed skip the lasers altogether.
+        if not numpy.array_equal(keys, self.laser_keys):
+            self.laser_keys = keys
+            self.laser_records = lasers.encode(live[self.laser_order])
+        if self.recorder:
+            self.recorder.record(self.tick, b"s", 0, STATE.pack(state_checksum(self)))
+            self.recorder.flush()
+
+    def view_of(self, player_obj):
+        if not self.view_radius:
+            return (self.player_versions, ALL_IN_VIEW, self.laser_keys), None
+        centre = player_obj.view_position
+        if centre is None:
+            indices = numpy.zeros(0, numpy.intp)
+            return (self.player_versions, NONE_IN_VIEW, self.laser_keys[indices]), indices
+        # Players out of view are still listed, only where they are is left out.
+        in_view = (numpy.abs(self.player_positions - centre) <= self.view_radius).all(axis=1)
+        near = (numpy.abs(self.laser_positions - centre) <= self.view_radius).all(axis=1)
+        indices = numpy.flatnonzero(near[self.laser_order])
+        return (self.player_versions, in_view, self.laser_keys[indices]), indices
+
+    def build_update(self, player_obj):
+        view, laser_indices = self.view_of(player_obj)
+        views = player_obj.views
+        views[self.tick] = view
+        while next(iter(views)) <= self.tick - SNAPSHOT_HISTORY:
+            del views[next(iter(views))]
+        # Deltas are against the last snapshot the client acked, anything older than the history is sent in full.
+        baseline = views.get(player_obj.acked)
+        baseline_id = player_obj.acked
+        if baseline is None:
+            baseline = (NO_PLAYERS, NONE_IN_VIEW, self.laser_keys[:0])
+            baseline_id = 0
+        if self.view_radius:
+            update, count, spans = self.build_delta(view, laser_indices, baseline)
+        else:
+            # With the whole map in view, every client acking the same snapshot has the same views of it and now, so
+            # their delta is only built once a tick.
+            delta = self.deltas.get(baseline_id)
+            if delta is None:
+                delta = self.deltas[baseline_id] = self.build_delta(view, laser_indices, baseline)
+            update, count, spans = delta
+        # The client's own player is never sent to them.
+        own = spans.get(player_obj.identity)
+        if own is None:
+            return SERVER_MESSAGES.encode("u", self.tick, baseline_id, count) + update
+        start, end, own_count = own
+        return b"".join((SERVER_MESSAGES.encode("u", self.tick, baseline_id, count - own_count), update[:start], update[end:]))
+
+    def build_delta(self, view, laser_indices, baseline):
+        versions, in_view, laser_keys = view
+        old_versions, old_in_view, old_keys = baseline
+        update = bytearray()
+        count = 0
+        # Where each player's messages are in update, {...player_id : (start, end, count),...}
+        spans = dict()
+        if versions is not old_versions or in_view is not old_in_view:
+            present = versions >= 0
+            # Coming into or going out of view always sends the position (or that it is out of view).
+            view_changed = present & ((old_versions < 0) | (in_view != old_in_view))
+            # Out of view, a player who has only moved has nothing to send.
+            changed = present & (versions > old_versions) & (in_view | (self.player_details > old_versions))
+            for player_id in numpy.flatnonzero(view_changed | changed).tolist():
+                start = len(update)
+                sent = count
+                player = self.players[player_id]
+                shown = bool(in_view[player_id])
+                moved_view = bool(view_changed[player_id])
+                since = int(old_versions[player_id])
+                if since < 0:
+                    # New to the client, every field is sent.
+                    update += player.full_message(shown)
+                    count += len(PLAYER_FIELDS)
+                    spans[player_id] = (start, len(update), len(PLAYER_FIELDS))
+                    continue
+                for kind, field_version in player.versions.items():
+                    if kind == "p":
+                        if moved_view or (shown and field_version > since):
+                            update += player.message(kind) if shown else player.out_of_view
+                            count += 1
+                    elif field_version > since:
+                        update += player.message(kind)
+                        count += 1
+                spans[player_id] = (start, len(update), count - sent)
+            for player_id in numpy.flatnonzero((old_versions >= 0) & ~present).tolist():
+                start = len(update)
+                update += SERVER_MESSAGES.encode("z", player_id)
+                count += 1
+                spans[player_id] = (start, len(update), 1)
+        if laser_keys is not old_keys:
+            # Lasers gone go first, a laser whose id has been reused is gone under its old key and new under its new one.
+            for laser_key in old_keys[~sorted_contains(laser_keys, old_keys)].tolist():
+                update += SERVER_MESSAGES.encode("o", laser_key & 0xFFFF)
+                count += 1
+            new = numpy.flatnonzero(~sorted_contains(old_keys, laser_keys))
+            if laser_indices is not None:
+                new = laser_indices[new]
+            update += self.laser_records[new].tobytes()
+            count += len(new)
+        return bytes(update), count, spans
+
+    def terminate(self, signum, frame):
+        # Stops the tick loop the same way as an interrupt, so the server still shuts down and finishes any recording.
+        self.server_state = "OFFLINE"
+
+    def run_headless(self):
+        self.start_server()
+        print("Server running at " + self.hostname + ":" + str(self.port) + ", " + str(self.tick_rate) + " ticks per second")
+        signal.signal(signal.SIGTERM, self.terminate)
+        self.scheduler = TickScheduler(self.serve_clients, self.tick_rate)
+        try:
+            self.scheduler.run_forever(lambda: self.server_state == "CONNECTED")
+        except KeyboardInterrupt:
+            pass
+        self.stop_server()
 
 class Mainloop(Server):
-    def __init__(self, hostname):
-        self.hostname = hostname
-        Server.__init__(self, hostname=self.hostname)
+    def __init__(self, hostname, port=6000, tick_rate=60, view_radius=VIEW_RADIUS, metrics_port=None, udp=False, rate_limits=None):
+        Server.__init__(self, hostname, port, tick_rate, view_radius, udp, rate_limits=rate_limits)
+        if metrics_port:
+            self.enable_metrics(metrics_port)
         pygame.init()
+        # Fonts and rendered labels are reused between frames, text_cache.hits and text_cache.misses show how well.
+        self.text_cache = TextCache()
 
         self.window_size = (1000, 600)
         self.window = pygame.display.set_mode(self.window_size)
@@ -280,7 +1267,7 @@ class Mainloop(Server):
 
     def display_text(self, text, size, colour, position, anchor, rel):
         # text = string, size = integer, colour = (RRR, GGG, BBB), position = (float, float), anchor = centre, left, right, top, bottom.
-        text_surface = pygame.font.Font("freesansbold.ttf", size).render(text, True, colour)
+        text_surface = self.text_cache.render(text, size, colour)
         text_rect = text_surface.get_rect()
         if rel:
             if anchor == "center":
@@ -357,9 +1344,24 @@ class Mainloop(Server):
                     quit()
             pygame.display.update()
 
+    def draw_profile(self):
+        # Milliseconds per phase over the last few seconds, drawn over the right of the player list.
+        profile = self.profiler.summary()
+        self.display_rect((0.5, 0.1), (0.5, 0.8), (0, 0, 0), True)
+        lines = ["PHASE         P50     P99     MAX"]
+        for phase, summary in list(profile["phases"].items()) + [("tick", profile["tick"])]:
+            if summary["count"]:
+                lines.append("%-10s %7.3f %7.3f %7.3f" % (phase.upper(), summary["p50"], summary["p99"], summary["max"]))
+        lines.append("LATE TICKS %d   OVERRUNS %d" % (profile["late_ticks"], self.scheduler.overruns if self.scheduler else 0))
+        lines.append("PLAYERS %d   LASERS %d" % (len(self.players), len(self.lasers)))
+        for index, line in enumerate(lines):
+            self.display_text(line, 15, (0, 225, 0), (0.52, 0.12 + index * 0.06), "topleft", True)
+
     def server_control(self):
         scroll = 0
         kick_buttons = dict()
+        show_profile = False
+        self.scheduler = TickScheduler(self.serve_clients, self.tick_rate)
         thread.start_new_thread(self.start_server, ())
         self.window.fill((255,255,255))
         while True:
@@ -367,7 +1369,8 @@ class Mainloop(Server):
                 # self.create_textrect((0.1, 0.1), (0.8, 0.7), (0, 225, 0), True, "INITIALSING SERVER AT:" + socket.gethostbyname(socket.gethostname()), 30, (0, 0, 0), "center")
                 self.create_textrect((0.1, 0.1), (0.8, 0.7), (0, 225, 0), True, "INITIALSING SERVER AT:" + self.hostname, 30, (0, 0, 0), "center")
             elif self.server_state == "CONNECTED":
-                self.serve_clients()
+                # The simulation runs on its own clock, the panel only decides how often it is redrawn.
+                self.scheduler.run_pending()
                 self.window.fill((225, 225, 225))
                 # self.create_textrect((0, 0), (0.5, 0.1), (225, 0, 0), True, "SERVER IP:  " + socket.gethostbyname(socket.gethostname()), 20, (225, 225, 225), "center")
                 self.create_textrect((0, 0), (0.5, 0.1), (225, 0, 0), True, "SERVER IP:  " + self.hostname, 20, (225, 225, 225), "center")
@@ -384,14 +1387,17 @@ class Mainloop(Server):
                 players = list(self.players.values())
                 for index in range(0, min(8, len(self.players))):
                     player_obj = players[scroll + index]
-                    self.display_text(player_obj.identity, 15, (0,0,0), (0, 0.2 + scroll * 0.1), "topleft", True)
+                    self.display_text(str(player_obj.identity).zfill(2), 15, (0,0,0), (0, 0.2 + scroll * 0.1), "topleft", True)
                     if player_obj.status:
                         self.display_text(player_obj.properties["n"], 15, (0,0,0) ,(0.2, 0.2 + index * 0.1),"topleft", True)
                         self.display_rect((0.4, 0.2 + scroll * 0.1),(0.1,0.1), player_obj.colour_formatted, True)
-                        self.display_text(player_obj.properties["h"], 15, (0,0,0) ,(0.6, 0.2 + index * 0.1), "topleft", True)
+                        self.display_text(str(player_obj.properties["h"]), 15, (0,0,0) ,(0.6, 0.2 + index * 0.1), "topleft", True)
                         self.display_text(str(player_obj.properties["k"]), 15, (0,0,0) ,(0.7, 0.2 + index * 0.1), "topleft", True)
                         kick_buttons[player_obj.identity] = self.create_textrect((0.8, 0.2 + index * 0.1), (0.2,0.1), (255,0,0), True, "KICK", 15, (255,255,255), "center")
 
+                if show_profile and self.profiler:
+                    self.draw_profile()
+
             for event in pygame.event.get():
                 if event.type == pygame.VIDEORESIZE:
                     self.window_size = event.size
@@ -408,6 +1414,10 @@ class Mainloop(Server):
                         elif event.scancode == 80:
                             if scroll > 0:
                                 scroll -= 1
+                        elif event.key == pygame.K_F3:
+                            show_profile = not show_profile
+                            if self.profiler is None:
+                                self.enable_metrics()
                     if event.type == pygame.MOUSEBUTTONUP:
                         for player_id in kick_buttons:
                             if kick_buttons[player_id].collidepoint(event.pos):
@@ -418,7 +1428,61 @@ class Mainloop(Server):
 
             pygame.display.update()
 
-hostname = input('Enter server hostname or IP address: ')
-Mainloop(hostname=hostname)
+def rate_limit(text):
+    # "l=4/4" --> ("l", (4.0, 4.0))
+    try:
+        kind, limit = text.split("=")
+        rate, burst = limit.split("/")
+        return kind, (float(rate), float(burst))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected KIND=RATE/BURST, e.g. l=4/4")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLASTR game server")
+    parser.add_argument("--headless", action="store_true", help="run without the pygame admin panel")
+    parser.add_argument("--host", help="hostname or IP address to listen on")
+    parser.add_argument("--port", type=int, default=6000)
+    parser.add_argument("--tick-rate", type=int, default=60, help="simulation ticks per second")
+    parser.add_argument("--view-radius", type=int, default=VIEW_RADIUS, help="how far from a player things are sent to them, 0 for the whole map")
+    parser.add_argument("--backend", choices=["select", "asyncio"], default="select", help="how client connections are served")
+    parser.add_argument("--queue-size", type=int, default=8, help="asyncio backend: most tick updates queued for one client")
+    parser.add_argument("--rate-limit", type=rate_limit, action="append", default=[], metavar="KIND=RATE/BURST",
+                        help="how many of a message type a client can send a second, and in a burst (repeatable)")
+    parser.add_argument("--udp", action="store_true", help="offer clients a UDP channel for positions and frames")
+    parser.add_argument("--udp-loss", type=float, default=0, help="share of datagrams to drop, to test the UDP channel as if on a lossy network")
+    parser.add_argument("--record", metavar="PATH", help="record the match to this file, to play back with replay.py")
+    parser.add_argument("--metrics-port", type=int, help="profile each tick and serve the metrics on this local port")
+    parser.add_argument("--slow-clients", choices=["drop", "disconnect"], default="drop", help="asyncio backend: what to do with a client whose queue is full")
+    args = parser.parse_args()
+    rate_limits = dict(RATE_LIMITS)
+    rate_limits.update(args.rate_limit)
+
+    if args.backend == "asyncio":
+        if not args.headless:
+            parser.error("the asyncio backend only runs with --headless")
+        if args.udp:
+            parser.error("the UDP channel only runs on the select backend")
+        from async_server import AsyncServer
+        server = AsyncServer(args.host or "0.0.0.0", args.port, args.tick_rate, args.view_radius, args.queue_size, args.slow_clients, rate_limits)
+        if args.metrics_port:
+            server.enable_metrics(args.metrics_port)
+        if args.record:
+            server.start_recording(args.record)
+        server.run_headless()
+    elif args.headless:
+        server = Server(args.host or "0.0.0.0", args.port, args.tick_rate, args.view_radius, args.udp, args.udp_loss, rate_limits)
+        if args.metrics_port:
+            server.enable_metrics(args.metrics_port)
+        if args.record:
+            server.start_recording(args.record)
+        server.run_headless()
+    else:
+        if pygame is None:
+            parser.error("pygame is not installed, use --headless")
+        if args.record:
+            parser.error("--record only runs with --headless")
+        hostname = args.host or input('Enter server hostname or IP address: ')
+        Mainloop(hostname, args.port, args.tick_rate, args.view_radius, args.metrics_port, args.udp, rate_limits)
 
 #bug the player seems to get an object of themselves back, but with the position messed up.
\ No newline at end of file
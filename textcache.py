@@ -0,0 +1,57 @@
+# --==BLOCK BLASTR TEXT CACHE==--
+# Shared by the game and the server admin panel, so labels drawn every frame are not rendered from scratch every frame.
+#
+# TEXT CACHE CLASS
+# Fonts are loaded once per size. Rendered text is kept in a least recently used cache, so the labels on screen stay
+# cached while text that is no longer drawn (e.g. a health value that has changed) is dropped once the cache is full.
+# Attributes:   Type:       Description:
+#   fonts           Dict        The loaded fonts by size, {...size : <Font>,...}
+#
+#   surfaces        OrderedDict The rendered text by (text, size, colour), least recently used first.
+#
+#   capacity        Integer     The most rendered text surfaces kept.
+#
+#   hits            Integer     The number of renders answered from the cache.
+#
+#   misses          Integer     The number of renders that had to be drawn.
+#
+# Methods:      Parameters:     Description:
+#   font            size (Integer)  Gives the font for a size, loading it the first time.
+#
+#   render          text (String)   Gives a surface of the text, rendering it only if it is not in the cache.
+#                   size (Integer)
+#                   colour (Tuple)
+
+from collections import OrderedDict
+
+import pygame
+
+FONT_FILE = "freesansbold.ttf"
+
+
+class TextCache:
+    def __init__(self, capacity=256):
+        self.fonts = dict()
+        self.surfaces = OrderedDict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = self.fonts[size] = pygame.font.Font(FONT_FILE, size)
+        return font
+
+    def render(self, text, size, colour):
+        key = (text, size, tuple(colour))
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.surfaces[key] = self.font(size).render(text, True, colour)
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+        return surface
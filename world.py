@@ -0,0 +1,122 @@
+# --==BLOCK BLASTR WORLD==--
+# The map and the geometry shared by the server and the client. Nothing in here needs pygame.
+#
+# Rects are (x, y, width, height) in world coordinates, the world is WORLD_SIZE x WORLD_SIZE.
+# A player is a PLAYER_SIZE square centred on their position, a laser a LASER_SIZE square centred on its position.
+# Lasers fly in a straight line at LASER_SPEED a tick, so where one is at any tick follows from where and when it was fired.
+#
+# COLLISION MAP CLASS
+# The walls baked once into a grid of every unit of the world, so checking a box against the map is a few array lookups
+# however many walls there are. The grid is kept as a summed area table: the number of wall units in any box is found
+# from its four corners.
+# Attributes:   Type:       Description:
+#   grid            Array       True for every unit of the world inside a wall, indexed [y, x].
+#
+#   sums            Array       sums[y, x] is the number of wall units above and left of (x, y).
+#
+# Methods:      Parameters:     Description:
+#   blocked         rect (Tuple)    Checks if a rect overlaps any wall.
+#
+#   blocked_many    positions (Array), size     Checks the boxes of the given size centred on each (x, y) row at once.
+#
+# SPATIAL HASH CLASS
+# Splits the world into square cells so collision checks only look at what is in the same cells.
+# Lasers all move every tick, so they are indexed in bulk each tick by sorting them on their cell.
+# Attributes:   Type:       Description:
+#   cell_size       Integer     The width and height of a cell.
+#
+#   columns         Integer     The number of cells along each side of the world.
+#
+# Methods:      Parameters:     Description:
+#   cells_for       rect (Tuple)    Gives the cells a rect overlaps.
+#
+#   index_points    positions (Array)   Indexes an array of (x, y) rows, replacing the last points indexed.
+#
+#   query_points    rect (Tuple)    Gives the rows of the indexed points in the cells a rect overlaps.
+
+import math
+
+import numpy
+
+WORLD_SIZE = 1000
+PLAYER_SIZE = 10
+LASER_SIZE = 3
+LASER_SPEED = 5
+LASER_VELOCITIES = {"w": (0, -LASER_SPEED), "s": (0, LASER_SPEED), "a": (-LASER_SPEED, 0), "d": (LASER_SPEED, 0)}
+
+# The walls as [(x, y), (width, height)].
+GAME_MAP = [[(40, 40), (80, 440)], [(160, 40), (600, 40)], [(760, 40), (120, 320)], [(160, 120), (520, 80)], [(320, 200), (80, 240)], [(160, 240), (80, 80)], [(440, 240), (160, 120)],
+            [(640, 240), (80, 320)], [(40, 520), (80, 440)], [(160, 360), (80, 80)], [(160, 440), (40, 440)], [(920, 40), (40, 240)], [(240, 640), (80, 240)], [(320, 640), (80, 40)],
+            [(400, 640), (160, 240)], [(760, 400), (40, 320)], [(160, 920), (640, 40)], [(760, 800), (40, 120)], [(600, 800), (160, 80)], [(920, 320), (40, 240)], [(920, 600), (40, 240)],
+            [(840, 400), (40, 560)], [(880, 880), (80, 80)]]
+
+
+def box(position, size):
+    # The rect of a square of the given size centred on a position.
+    return (position[0] - size / 2, position[1] - size / 2, size, size)
+
+
+def laser_position(origin, direction, spawn_tick, tick):
+    # Where a laser fired from origin on spawn_tick is on a later tick.
+    velocity = LASER_VELOCITIES[direction]
+    return (origin[0] + velocity[0] * (tick - spawn_tick), origin[1] + velocity[1] * (tick - spawn_tick))
+
+
+class CollisionMap:
+    def __init__(self, walls=GAME_MAP, size=WORLD_SIZE):
+        self.size = size
+        self.grid = numpy.zeros((size, size), bool)
+        for position, wall_size in walls:
+            self.grid[position[1]:position[1] + wall_size[1], position[0]:position[0] + wall_size[0]] = True
+        self.sums = numpy.zeros((size + 1, size + 1), numpy.int32)
+        self.sums[1:, 1:] = self.grid.cumsum(axis=0).cumsum(axis=1)
+
+    def blocked(self, rect):
+        # Edges that only touch a wall do not count, the same as pygame.Rect.colliderect.
+        left = min(max(math.floor(rect[0]), 0), self.size)
+        top = min(max(math.floor(rect[1]), 0), self.size)
+        right = min(max(math.ceil(rect[0] + rect[2]), 0), self.size)
+        bottom = min(max(math.ceil(rect[1] + rect[3]), 0), self.size)
+        sums = self.sums
+        return sums[bottom, right] - sums[top, right] - sums[bottom, left] + sums[top, left] > 0
+
+    def blocked_many(self, positions, size):
+        corners = numpy.clip(numpy.floor(positions - size / 2), 0, self.size).astype(numpy.intp)
+        ends = numpy.clip(numpy.ceil(positions + size / 2), 0, self.size).astype(numpy.intp)
+        sums = self.sums
+        return sums[ends[:, 1], ends[:, 0]] - sums[corners[:, 1], ends[:, 0]] - sums[ends[:, 1], corners[:, 0]] + sums[corners[:, 1], corners[:, 0]] > 0
+
+
+class SpatialHash:
+    def __init__(self, cell_size=40, size=WORLD_SIZE):
+        self.cell_size = cell_size
+        self.columns = -(-size // cell_size)
+        self.point_order = numpy.zeros(0, numpy.intp)
+        self.point_cells = numpy.zeros(0, numpy.intp)
+
+    def cells_for(self, rect):
+        last = self.columns - 1
+        left = min(max(int(rect[0] // self.cell_size), 0), last)
+        right = min(max(int((rect[0] + rect[2]) // self.cell_size), 0), last)
+        top = min(max(int(rect[1] // self.cell_size), 0), last)
+        bottom = min(max(int((rect[1] + rect[3]) // self.cell_size), 0), last)
+        return tuple([row * self.columns + column for row in range(top, bottom + 1) for column in range(left, right + 1)])
+
+    def point_cell_ids(self, positions):
+        cells = numpy.clip(positions // self.cell_size, 0, self.columns - 1).astype(numpy.intp)
+        return cells[:, 1] * self.columns + cells[:, 0]
+
+    def index_points(self, positions):
+        cells = self.point_cell_ids(positions)
+        self.point_order = numpy.argsort(cells, kind="stable")
+        self.point_cells = cells[self.point_order]
+
+    def query_points(self, rect):
+        found = list()
+        for cell in self.cells_for(rect):
+            start, end = numpy.searchsorted(self.point_cells, (cell, cell + 1))
+            if end > start:
+                found.append(self.point_order[start:end])
+        if not found:
+            return self.point_order[:0]
+        return numpy.concatenate(found)